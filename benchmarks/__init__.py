@@ -0,0 +1,4 @@
+"""Benchmarks for pegger
+
+Run each module with `python -m benchmarks.<name>` from the root of the
+repository."""
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Benchmark each combinator on its own
+
+Each case is a grammar that spends nearly all of its time in one kind
+of pattern, parsed at a few sizes to give its throughput and how its
+running time grows."""
+
+import sys
+
+import pegger as pg
+
+from benchmarks import measure
+
+KB = 1024
+
+# The exponent above which a case is reported as slower than linear
+LIMIT = 1.3
+
+
+def letters(size):
+    return measure.repeat_to("aaaaaaaaab", size)
+
+def words(size):
+    return measure.repeat_to("Some words, and some more words.\n", size)
+
+def indented(size):
+    return "list:\n" + measure.repeat_to("  item one\n  item two\n", size)
+
+def markup(size):
+    return measure.repeat_to("a <b> & c ", size)
+
+def footnote(size):
+    # Each footnote is found ahead of a short paragraph
+    return measure.repeat_to("A short paragraph [^note]\n", size)
+
+
+CASES = [
+    ("Some", letters, lambda: pg.Many(pg.Some("a"), pg.Text("b"))),
+    ("Words", words, lambda: pg.Many(pg.Words(), pg.Text(","), pg.Text("\n"))),
+    ("Text", letters, lambda: pg.Many(pg.Text("a"), pg.Text("b"))),
+    ("Many", letters, lambda: pg.Many(pg.Many(pg.Text("a")), pg.Text("b"))),
+    ("OneOf", words, lambda: pg.Many(pg.OneOf(*(list("xyz.,\n ") + [pg.Words("Somewrdsan")])))),
+    ("Indented", indented, lambda: pg.AllOf(
+        "list:\n",
+        pg.Indented(pg.Many(pg.NamedPattern('item', pg.Words()), pg.Ignore("\n"))),
+        pg.Ignore("\n"))),
+    ("Lookahead", footnote, lambda: pg.Many(
+        pg.AllOf(
+            pg.Lookahead(pg.NamedPattern('note', pg.AllOf(" [^", pg.Words(), "]"))),
+            pg.NamedPattern('paragraph', pg.Words()),
+            pg.Ignore("\n")))),
+    ("Not", words, lambda: pg.Many(pg.Not("*"))),
+    ("Until", words, lambda: pg.Until("*")),
+    ("Escaped", markup, lambda: pg.Escaped(pg.Many(pg.Not("*")))),
+    ]
+
+def main(sizes=(10 * KB, 100 * KB, 1000 * KB)):
+    slow = []
+    for name, make_data, make_grammar in CASES:
+        exponent = measure.scaling(name, make_data, make_grammar, sizes)
+        if (exponent is not None) and (exponent > LIMIT):
+            slow.append(name)
+    if slow:
+        print "Slower than linear: %s" % ", ".join(slow)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Benchmark parsing into a compact tree.Tree against a plain match
+
+Prints the time and peak memory of each at a few sizes of the scaling
+document, exiting with 1 if the tree doesn't use less memory than the
+match at the largest size.  The largest size can be given on the
+command line, eg `python -m benchmarks.compact 10000000`."""
+
+import sys
+
+import pegger as pg
+
+from benchmarks import measure, scaling
+
+SIZES = (100000, 1000000, 2000000)
+
+
+def parse_compact(data, grammar):
+    return pg.parse_string(data, grammar, compact=True)
+
+def main(sizes=SIZES):
+    memories = {}
+    for size in sizes:
+        for name, parse in (("match", pg.parse_string), ("tree", parse_compact)):
+            length, seconds, memory = measure.measure(
+                scaling.make_data, scaling.make_document, size, repeat=1, parse=parse)
+            memories[name] = memory
+            print "%-8s %10d %9.3fs %8.2f MB/s %8.1f MB" % (
+                name, length, seconds, measure.throughput(length, seconds),
+                memory / float(measure.MB))
+    if memories["tree"] >= memories["match"]:
+        print "The tree used more memory than the match"
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main([size for size in SIZES if size <= int(sys.argv[1])]))
+    sys.exit(main())
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Compare signalling failure with None against raising NoPatternFound
+
+Each alternative of an alternation heavy grammar is wrapped, either in
+a pattern that passes failures on as None, as patterns do now, or in
+one that raises and catches NoPatternFound, as they used to."""
+
+import timeit
+
+import pegger as pg
+
+
+class Passing(pg.BasePatternCreator):
+    "Signal failure by returning None"
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def match_at(self, text, pos, name=""):
+        return self.pattern.match_at(text, pos, name)
+
+
+class Raising(Passing):
+    "Signal failure by raising NoPatternFound"
+    def match_at(self, text, pos, name=""):
+        try:
+            return self.raise_failure(text, pos, name)
+        except pg.NoPatternFound:
+            return None
+
+    def raise_failure(self, text, pos, name):
+        result = self.pattern.match_at(text, pos, name)
+        if result is None:
+            raise pg.NoPatternFound
+        return result
+
+def make_grammar(wrapper):
+    "A Many over twenty alternatives, most of which fail"
+    options = [
+        wrapper(pg.NamedPattern("tag_%s" % letter, pg.Text("<%s>" % letter)))
+        for letter in "abcdefghijklmnopqrs"]
+    options.append(wrapper(pg.Words()))
+    return pg.Many(*options)
+
+def main(size=20000, repeat=5):
+    data = "Some words <s> and more <r> words. " * (size // 36)
+    for wrapper in [Passing, Raising]:
+        grammar = make_grammar(wrapper)
+        timer = timeit.Timer(lambda: pg.parse_string(data, grammar))
+        best = min(timer.repeat(repeat, 1))
+        print "%-8s %.4fs" % (wrapper.__name__, best)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Helpers for timing parses, and the memory they use
+
+Each measurement is made in a new process, so that the peak memory of
+one parse isn't hidden by an earlier, larger one."""
+
+import math
+import multiprocessing
+import resource
+import timeit
+
+import pegger as pg
+
+MB = 1024 * 1024
+
+
+def best_time(data, grammar, repeat=3, parse=pg.parse_string):
+    "The fastest of repeat parses of data with grammar, in seconds"
+    timer = timeit.Timer(lambda: parse(data, grammar))
+    return min(timer.repeat(repeat, 1))
+
+def _measure_in_child(connection, make_data, make_grammar, size, repeat, parse):
+    try:
+        data = make_data(size)
+        grammar = make_grammar()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        seconds = best_time(data, grammar, repeat, parse)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Checked afterwards, so that this match doesn't raise the peak first
+        match, rest = grammar.match(data)
+        if rest:
+            raise ValueError("The grammar stopped %s characters from the end" % len(rest))
+    except Exception, e:
+        connection.send(e)
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        connection.send((len(data), seconds, (after - before) * 1024))
+    connection.close()
+
+def measure(make_data, make_grammar, size, repeat=3, parse=pg.parse_string):
+    """Parse make_data(size) with make_grammar() in a new process, and
+    return the length of the data, the best time, and how much the
+    peak memory of the process grew while parsing, in bytes
+
+    parse is called with the data and the grammar to parse it."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_measure_in_child,
+        args=(sender, make_data, make_grammar, size, repeat, parse))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def throughput(length, seconds):
+    "The rate that length characters were parsed at, in MB/s"
+    return length / float(MB) / seconds
+
+def fit_exponent(sizes, times):
+    """Fit times = c * sizes ** k by least squares on a log-log scale,
+    and return k, which is about 1 for a linear parser and 2 for a
+    quadratic one"""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(seconds, 1e-9)) for seconds in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if not spread:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+
+def repeat_to(block, size):
+    "Repeat block until it is at least size characters long"
+    return block * (size // len(block) + 1)
+
+def scaling(name, make_data, make_grammar, sizes, repeat=3):
+    """Print the throughput and peak memory of the grammar at each
+    size, and return the fitted exponent of its running time"""
+    lengths = []
+    times = []
+    for size in sizes:
+        length, seconds, memory = measure(make_data, make_grammar, size, repeat)
+        lengths.append(length)
+        times.append(seconds)
+        print "%-12s %10d %9.3fs %8.2f MB/s %8.1f MB" % (
+            name, length, seconds, throughput(length, seconds), memory / float(MB))
+    exponent = fit_exponent(lengths, times)
+    if exponent is not None:
+        print "%-12s time ~ size ** %.2f" % (name, exponent)
+    return exponent
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Benchmark whole grammars on documents from 1KB to 10MB
+
+Prints the throughput and peak memory at each size, and fits how the
+running time grows with the size of the document, exiting with 1 if
+it grows faster than LIMIT allows, eg because a change made part of
+the parser quadratic.  The largest size can be given on the command
+line, eg `python -m benchmarks.scaling 1000000`."""
+
+import sys
+
+import pegger as pg
+
+from benchmarks import measure
+
+SIZES = (1000, 10000, 100000, 1000000, 10000000)
+
+LIMIT = 1.3
+
+DOCUMENT = """A paragraph with *some emphasis* in it,
+that goes on to a second line.
+
+* A bullet
+  * A nested bullet, with *emphasis*
+  * Another nested bullet
+    * And one nested further
+* Another bullet
+
+"""
+
+
+def make_document():
+    "A markdown-ish grammar of paragraphs and nested bullets"
+    words = pg.Words(pg.CharClass("a-zA-Z ,."))
+    emphasis = pg.NamedPattern(
+        'emphasis',
+        pg.AllOf(
+            pg.Ignore("*"),
+            words,
+            pg.Ignore("*")))
+    line = pg.AllOf(
+        pg.Many(
+            emphasis,
+            words),
+        pg.Ignore(pg.Optional("\n")))
+
+    @pg.lazy
+    def item():
+        return pg.AllOf(
+            pg.Ignore("* "),
+            line,
+            pg.Optional(
+                pg.Indented(
+                    pg.Many(bullets))))
+
+    bullets = pg.NamedPattern('bullets', pg.Many(item))
+    paragraph = pg.NamedPattern('paragraph', pg.Many(line))
+    return pg.NamedPattern(
+        'document',
+        pg.Many(
+            bullets,
+            paragraph,
+            pg.Ignore("\n")))
+
+def make_data(size):
+    return measure.repeat_to(DOCUMENT, size)
+
+def main(sizes=SIZES):
+    exponent = measure.scaling("document", make_data, make_document, sizes, repeat=1)
+    if (exponent is not None) and (exponent > LIMIT):
+        print "Slower than linear"
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main([size for size in SIZES if size <= int(sys.argv[1])]))
+    sys.exit(main())
@@ -1 +1,6 @@
 from pegger import *
+from codegen import compile
+from tree import Tree, compact
+from analysis import validate
+from incremental import parse, reparse
+from profiling import profile, Profile, backtracking, Backtracking
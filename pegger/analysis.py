@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Static analysis of grammars
+
+`Analysis` walks every pattern that can be reached from a grammar's
+root, and works out things about them that don't depend on the text
+being parsed, like which patterns can match without consuming any
+text, and which characters their matches can start with."""
+
+import warnings
+
+import pegger
+
+# The first set of a pattern that could start with anything
+ANY = None
+
+# Ranges larger than this aren't expanded into first sets
+MAX_RANGE = 256
+
+
+def _union(sets):
+    "The union of the first sets, which is ANY if any of them are"
+    found = set()
+    for chars in sets:
+        if chars is ANY:
+            return ANY
+        found.update(chars)
+    return frozenset(found)
+
+def letter_set(letters):
+    "The first set of Words(letters)"
+    if not isinstance(letters, pegger.CharClass):
+        return frozenset(letters)
+    elif letters.negated:
+        return ANY
+    chars = set(letters.chars)
+    for start, end in letters.ranges:
+        if ord(end) - ord(start) > MAX_RANGE:
+            return ANY
+        chars.update(unichr(i) if isinstance(start, unicode) else chr(i)
+                     for i in range(ord(start), ord(end) + 1))
+    return frozenset(chars)
+
+def sub_patterns(pattern):
+    "The patterns that pattern uses directly"
+    if type(pattern) is pegger.Lazy:
+        return [pattern.resolve()]
+    found = list(getattr(pattern, "options", None) or [])
+    for attribute in ("pattern", "span", "initial_indent", "indent_pattern"):
+        sub_pattern = getattr(pattern, attribute, None)
+        if isinstance(sub_pattern, pegger.BasePatternCreator):
+            found.append(sub_pattern)
+    return found
+
+
+class Analysis(object):
+    """The results of analysing the grammar that starts at pattern"""
+    def __init__(self, pattern):
+        self.root = pattern
+        self.patterns = []
+        seen = set()
+        stack = [pattern]
+        while stack:
+            pattern = stack.pop()
+            if id(pattern) in seen:
+                continue
+            seen.add(id(pattern))
+            self.patterns.append(pattern)
+            stack.extend(reversed(sub_patterns(pattern)))
+        self.nullable = self.find_nullable()
+        self.first = self.find_first()
+        self.infallible = self.find_infallible()
+
+    def find(self, rule):
+        """Find which patterns rule is true of
+
+        rule is called with a pattern and what has been found so far.
+        Recursive patterns are taken to be false until shown otherwise,
+        and the rule is applied until nothing changes."""
+        found = dict((id(pattern), False) for pattern in self.patterns)
+        changed = True
+        while changed:
+            changed = False
+            for pattern in self.patterns:
+                if (not found[id(pattern)]) and rule(pattern, found):
+                    found[id(pattern)] = True
+                    changed = True
+        return found
+
+    def find_nullable(self):
+        "Find which patterns can match without consuming any text"
+        return self.find(self._nullable_given)
+
+    def find_infallible(self):
+        "Find which patterns match wherever they are tried"
+        return self.find(self._infallible_given)
+
+    def _nullable_given(self, pattern, nullable):
+        "Whether pattern is nullable, given what is known about its parts"
+        kind = type(pattern)
+        if kind is pegger.Text:
+            return not pattern.pattern
+        elif kind in (pegger.Insert, pegger.EOF, pegger.Optional):
+            return True
+        elif kind is pegger.AllOf:
+            return all(nullable[id(option)] for option in pattern.options)
+        elif kind in (pegger.OneOf, pegger.Many):
+            return any(nullable[id(option)] for option in pattern.options)
+        elif kind is pegger.CountOf:
+            return (pattern.count == 0) or nullable[id(pattern.pattern)]
+        elif kind in (pegger.Some, pegger.Words, pegger.Not, pegger.Until, pegger.Function):
+            return False
+        elif kind is pegger.Deferred:
+            return bool(pattern.span) and nullable[id(pattern.span)]
+        sub_pattern = sub_patterns(pattern)[:1]
+        return bool(sub_pattern) and nullable[id(sub_pattern[0])]
+
+    def _infallible_given(self, pattern, infallible):
+        "Whether pattern always matches, given what is known about its parts"
+        kind = type(pattern)
+        if kind is pegger.Text:
+            return not pattern.pattern
+        elif kind in (pegger.Insert, pegger.Optional):
+            return True
+        elif kind is pegger.AllOf:
+            return all(infallible[id(option)] for option in pattern.options)
+        elif kind in (pegger.OneOf, pegger.Many):
+            return any(infallible[id(option)] for option in pattern.options)
+        elif kind is pegger.CountOf:
+            return (pattern.count == 0) or infallible[id(pattern.pattern)]
+        elif kind in (pegger.NamedPattern, pegger.Lazy, pegger.Ignore,
+                      pegger.Join, pegger.Escaped):
+            return infallible[id(sub_patterns(pattern)[0])]
+        return False
+
+    def is_nullable(self, pattern):
+        "Whether pattern can match without consuming any text"
+        return self.nullable[id(pattern)]
+
+    def find_first(self):
+        """Find the set of characters that each pattern's matches can
+        start with, or ANY if it isn't known
+
+        Nullable patterns can also match whatever follows them."""
+        first = dict((id(pattern), frozenset()) for pattern in self.patterns)
+        changed = True
+        while changed:
+            changed = False
+            for pattern in self.patterns:
+                if first[id(pattern)] is ANY:
+                    continue
+                chars = self._first_given(pattern, first)
+                if chars != first[id(pattern)]:
+                    first[id(pattern)] = chars
+                    changed = True
+        return first
+
+    def _first_given(self, pattern, first):
+        "The first set of pattern, given what is known about its parts"
+        kind = type(pattern)
+        if kind in (pegger.Text, pegger.Some):
+            return frozenset(pattern.pattern[:1])
+        elif kind is pegger.Words:
+            return letter_set(pattern.letters)
+        elif kind in (pegger.Insert, pegger.EOF):
+            return frozenset()
+        elif (kind is pegger.Deferred) and pattern.span:
+            return first[id(pattern.span)]
+        elif kind in (pegger.AllOf, pegger.OneOf, pegger.Many, pegger.NamedPattern,
+                      pegger.Lazy, pegger.Optional, pegger.Ignore, pegger.Join,
+                      pegger.Escaped, pegger.CountOf):
+            return _union(first[id(p)] for p in self.left_calls(pattern))
+        return ANY
+
+    def get_first(self, pattern):
+        "The characters that pattern's matches can start with, or ANY"
+        return self.first[id(pattern)]
+
+    def dispatch_table(self, pattern):
+        """Map each character to the options of a OneOf or Many that
+        could match starting with it
+
+        Returns the map, and the options for any other character (or
+        the end of the text), or None if the options can't be narrowed
+        down."""
+        def always(option):
+            return (self.first[id(option)] is ANY) or self.nullable[id(option)]
+        default = tuple(o for o in pattern.options if always(o))
+        if len(default) == len(pattern.options):
+            return None
+        chars = _union(self.first[id(o)] for o in pattern.options if not always(o))
+        table = {}
+        for char in chars:
+            table[char] = tuple(
+                o for o in pattern.options
+                if always(o) or (char in self.first[id(o)]))
+        return (table, default)
+
+    def left_calls(self, pattern):
+        "The patterns that pattern can match at the position it starts at"
+        kind = type(pattern)
+        if kind is pegger.AllOf:
+            called = []
+            for option in pattern.options:
+                called.append(option)
+                if not self.nullable[id(option)]:
+                    break
+            return called
+        elif kind is pegger.Indented:
+            # The pattern itself matches against the indented text
+            return [p for p in (pattern.initial_indent, pattern.indent_pattern) if p]
+        elif kind is pegger.Deferred:
+            # The pattern itself matches later, against the span's text
+            return [p for p in (pattern.span,) if p]
+        elif (kind is pegger.CountOf) and (pattern.count == 0):
+            return []
+        return sub_patterns(pattern)
+
+    def left_recursive(self):
+        """The lazy patterns that can call themselves at the position
+        they start at"""
+        found = []
+        for pattern in self.patterns:
+            if type(pattern) is not pegger.Lazy:
+                continue
+            seen = set()
+            stack = list(self.left_calls(pattern))
+            while stack:
+                called = stack.pop()
+                if called is pattern:
+                    found.append(pattern)
+                    break
+                elif id(called) not in seen:
+                    seen.add(id(called))
+                    stack.extend(self.left_calls(called))
+        return found
+
+    def mark(self):
+        """Store what the patterns need to know when matching: whether
+        each lazy pattern is left recursive, and the dispatch table of
+        each OneOf and Many"""
+        found = set(id(pattern) for pattern in self.left_recursive())
+        for pattern in self.patterns:
+            if type(pattern) is pegger.Lazy:
+                pattern.left_recursive = id(pattern) in found
+            elif type(pattern) in (pegger.OneOf, pegger.Many):
+                pattern.dispatch = self.dispatch_table(pattern) or False
+
+    def shadows(self, earlier, later):
+        "Whether earlier matches wherever later does"
+        if self.infallible[id(earlier)]:
+            return True
+        earlier, later = _text_of(earlier), _text_of(later)
+        return (earlier is not None) and (later is not None) and later.startswith(earlier)
+
+    def never_stop(self):
+        "Describe the options of each Many that can match nothing, so that it would never stop"
+        found = []
+        for pattern in self.patterns:
+            if type(pattern) is pegger.Many:
+                for option in pattern.options:
+                    if self.nullable[id(option)]:
+                        found.append("%r can match nothing, so %r would never stop" % (
+                            option, pattern))
+        return found
+
+    def unreachable(self):
+        """Describe the options of each OneOf and Many that can never be
+        reached, because an earlier one matches wherever they would"""
+        found = []
+        for pattern in self.patterns:
+            if type(pattern) not in (pegger.OneOf, pegger.Many):
+                continue
+            for i, option in enumerate(pattern.options):
+                for earlier in pattern.options[:i]:
+                    if self.shadows(earlier, option):
+                        found.append("%r in %r is never reached, because %r matches first" % (
+                            option, pattern, earlier))
+                        break
+        return found
+
+def _text_of(pattern):
+    "The text that pattern matches, if it is a Text, or None"
+    seen = set()
+    while type(pattern) in (pegger.NamedPattern, pegger.Lazy, pegger.Ignore,
+                            pegger.Join, pegger.Escaped):
+        if id(pattern) in seen:
+            return None
+        seen.add(id(pattern))
+        pattern = sub_patterns(pattern)[0]
+    if type(pattern) is pegger.Text:
+        return pattern.pattern
+    return None
+
+def validate(pattern, grammar=None):
+    """Check the grammar starting at pattern, raising GrammarError if
+    it has a Many that would never stop, and warning with
+    GrammarWarning about options that can never be reached"""
+    grammar = grammar or Analysis(pattern)
+    errors = grammar.never_stop()
+    if errors:
+        raise pegger.GrammarError("\n".join(errors))
+    for problem in grammar.unreachable():
+        warnings.warn(problem, pegger.GrammarWarning, stacklevel=2)
+    return grammar
@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+"""Compiles patterns into Python functions
+
+Each pattern in the grammar becomes a Python function that takes
+`(text, pos, name)` and returns `(match, text, end)`, or None if it
+doesn't match, just like `match_at`.  Terminal patterns (`Text`,
+`Some`, `Words`, `Not`, `Insert` and `EOF`) are written inline into
+the functions of the patterns that use them, and the names of
+`NamedPattern` and `lazy` patterns are worked out when the grammar is
+compiled rather than on every match.
+
+`Indented`, `Lookahead` and `Deferred` still run in the interpreter,
+with their sub-patterns compiled, and other pattern classes are called
+through their `match_at`.  So the gain depends on the grammar: a
+grammar of paragraphs and emphasis parses about 1.7x faster, but one
+that spends most of its time in `Indented`, like the nested bullets
+of benchmarks.scaling, gains very little."""
+
+import copy
+import re
+
+import pegger
+import analysis
+from pegger import _is_transparent
+
+
+class Compiled(pegger.BasePatternCreator):
+    """A pattern that has been compiled into a Python function"""
+    def __init__(self, pattern, function, source=None):
+        self.pattern = pattern
+        self.function = function
+        self.source = source
+
+    def match_at(self, text, pos, name=""):
+        return self.function(text, pos, name)
+
+    def __repr__(self):
+        return "<%s pattern=%r>" % (self.__class__.__name__, self.pattern)
+
+
+class Inline(object):
+    """The code to match a pattern inside another pattern's function
+
+    `lines` are run first, and if `condition` is then true the pattern
+    matched.  If kind is "leaf" the match is `[name, value]`, if it is
+    "chars" it is `name` followed by each character of `value`, if it
+    is "ignore" the match is empty, and if it is "call" the match is
+    `r[0]`.  `rest` and `end` give the text and position after the
+    match."""
+    def __init__(self, kind, lines, condition, end, rest="text",
+                 name=None, value=None, nonempty=True):
+        self.kind = kind
+        self.lines = lines
+        self.condition = condition
+        self.end = end
+        self.rest = rest
+        self.name = name
+        self.value = value
+        self.nonempty = nonempty
+
+    def failed(self):
+        "An expression that is true if the pattern didn't match"
+        if self.condition == "r is not None":
+            return "r is None"
+        return "not (%s)" % self.condition
+
+    def advance(self):
+        "The lines that move on to after the match"
+        if self.rest == "text":
+            return ["pos = %s" % self.end]
+        else:
+            return ["text, pos = %s, %s" % (self.rest, self.end)]
+
+
+def resolve(pattern, name):
+    """Look through named and lazy patterns to the pattern that does
+    the matching, and the name it will be given"""
+    seen = set()
+    while type(pattern) in (pegger.NamedPattern, pegger.Lazy):
+        if id(pattern) in seen:
+            break
+        seen.add(id(pattern))
+        if type(pattern) is pegger.NamedPattern:
+            name = pattern.name
+            pattern = pattern.pattern
+        else:
+            name = name or pattern.name
+            pattern = pattern.resolve()
+    return (pattern, name)
+
+def _indent(lines, level=1):
+    return [("    " * level) + line for line in lines]
+
+
+class NotRegular(Exception):
+    "The pattern can't be matched with a regular expression"
+
+
+class RegexBuilder(object):
+    """Builds a regular expression that matches the same text as a
+    pattern
+
+    The choices and repetitions of a PEG never backtrack, so each of
+    them is made atomic with the `(?=(...))\1` idiom."""
+    def __init__(self):
+        self.groups = 0
+        self.building = set()
+
+    def build(self, pattern, top=False):
+        """Get the regular expression for pattern, and whether it can
+        match without consuming any text"""
+        pattern, name = resolve(pattern, "")
+        if id(pattern) in self.building:
+            raise NotRegular(pattern)
+        self.building.add(id(pattern))
+        try:
+            return self.build_pattern(pattern, top)
+        finally:
+            self.building.discard(id(pattern))
+
+    def atomic(self, build, top):
+        "Make the regex returned by build atomic, unless it's the top"
+        if top:
+            return build()
+        self.groups += 1
+        group = self.groups
+        regex, nullable = build()
+        return ("(?=(%s))\\%s" % (regex, group), nullable)
+
+    def build_pattern(self, pattern, top):
+        kind = type(pattern)
+        if kind is pegger.Text:
+            return (re.escape(pattern.pattern), not pattern.pattern)
+        elif (kind is pegger.Some) and (len(pattern.pattern) == 1):
+            return self.atomic(
+                lambda: (re.escape(pattern.pattern) + "+", False), top)
+        elif kind is pegger.Words:
+            return self.atomic(
+                lambda: (pegger._character_class(pattern.letters) + "+", False), top)
+        elif kind is pegger.Not:
+            regex, nullable = self.build(pattern.pattern)
+            return ("(?!%s)[\\s\\S]" % regex, False)
+        elif kind is pegger.Insert:
+            return ("", True)
+        elif kind is pegger.EOF:
+            return ("\\Z", True)
+        elif kind in (pegger.Ignore, pegger.Join):
+            return self.build(pattern.pattern, top)
+        elif kind is pegger.Optional:
+            def build():
+                regex, nullable = self.build(pattern.pattern)
+                return ("(?:%s)?" % regex, True)
+            return self.atomic(build, top)
+        elif kind is pegger.AllOf:
+            options = [self.build(option) for option in pattern.options]
+            return (
+                "".join("(?:%s)" % regex for regex, nullable in options),
+                all(nullable for regex, nullable in options))
+        elif kind is pegger.CountOf:
+            regex, nullable = self.build(pattern.pattern)
+            return (
+                "(?:%s){%s}" % (regex, pattern.count),
+                nullable or (pattern.count == 0))
+        elif (kind in (pegger.OneOf, pegger.Many)) and pattern.options:
+            def build():
+                options = [self.build(option) for option in pattern.options]
+                regex = "|".join("(?:%s)" % regex for regex, nullable in options)
+                nullable = any(nullable for regex, nullable in options)
+                if kind is pegger.OneOf:
+                    return ("(?:%s)" % regex, nullable)
+                elif nullable:
+                    # Many would never stop matching
+                    raise NotRegular(pattern)
+                else:
+                    return ("(?:%s)+" % regex, False)
+            return self.atomic(build, top)
+        raise NotRegular(pattern)
+
+def regex_for(pattern):
+    """Get a compiled regular expression that matches the same text as
+    pattern, and whether it can match nothing, or raise NotRegular"""
+    regex, nullable = RegexBuilder().build(pattern, top=True)
+    try:
+        return (re.compile(regex), nullable)
+    except (re.error, AssertionError, OverflowError, RuntimeError):
+        # Too many groups, or too deeply nested for re
+        raise NotRegular(pattern)
+
+def is_flat(pattern):
+    """Whether the match of pattern, when merged into its parent, is
+    just strings that join to make the text that was matched"""
+    pattern, name = resolve(pattern, "")
+    kind = type(pattern)
+    if not _is_transparent(name):
+        return False
+    elif kind in (pegger.Text, pegger.Some, pegger.Words, pegger.Not, pegger.EOF):
+        return True
+    elif kind in (pegger.Join, pegger.Optional, pegger.CountOf):
+        return is_flat(pattern.pattern)
+    elif kind in (pegger.AllOf, pegger.OneOf, pegger.Many):
+        return all(is_flat(option) for option in pattern.options)
+    else:
+        return False
+
+def _is_character(pattern):
+    "Whether pattern matches a single character and is merged into its parent"
+    pattern, name = resolve(pattern, "")
+    return _is_transparent(name) and (
+        (type(pattern) is pegger.Not) or
+        ((type(pattern) is pegger.Text) and (len(pattern.pattern) == 1)))
+
+
+class Compiler(object):
+    """Generates the source for a grammar"""
+    terminals = (
+        pegger.Text, pegger.Some, pegger.Words, pegger.Not,
+        pegger.Insert, pegger.EOF)
+
+    bodies = {
+        pegger.Text: "body_terminal",
+        pegger.Some: "body_terminal",
+        pegger.Words: "body_terminal",
+        pegger.Not: "body_terminal",
+        pegger.Insert: "body_terminal",
+        pegger.EOF: "body_terminal",
+        pegger.NamedPattern: "body_NamedPattern",
+        pegger.Lazy: "body_Lazy",
+        pegger.Ignore: "body_Ignore",
+        pegger.Optional: "body_Optional",
+        pegger.AllOf: "body_AllOf",
+        pegger.OneOf: "body_OneOf",
+        pegger.Many: "body_Many",
+        pegger.CountOf: "body_CountOf",
+        pegger.Join: "body_Join",
+        pegger.Escaped: "body_Escaped",
+        }
+
+    def __init__(self, regex=False):
+        self.regex = regex
+        self.function_names = {}
+        self.queue = []
+        self.functions = []
+        self.fixups = []
+        self.namespace = {
+            '_add': pegger._add_match_to_result,
+            'has_text': pegger._has_text,
+            'filter_match': pegger.filter_match,
+            'do_escape': pegger.do_escape,
+            'IndentedText': pegger.IndentedText,
+            'grow_seed': pegger._grow_seed,
+            }
+        self.left_recursive = set()
+
+    def constant(self, value):
+        "Put value in the namespace of the generated code"
+        if isinstance(value, basestring):
+            return repr(value)
+        name = "_c%s" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def function_for(self, pattern):
+        "Get the name of the function that matches pattern"
+        try:
+            return self.function_names[id(pattern)]
+        except KeyError:
+            function_name = "_match_%s" % len(self.function_names)
+            self.function_names[id(pattern)] = function_name
+            self.queue.append((function_name, pattern))
+            return function_name
+
+    def compile(self, pattern):
+        "Generate the source for pattern and everything it uses"
+        grammar = analysis.validate(pattern)
+        for rule in grammar.left_recursive():
+            self.left_recursive.add(id(resolve(rule, "")[0]))
+        root = self.function_for(pattern)
+        while self.queue:
+            function_name, pattern = self.queue.pop(0)
+            lines = self.function_body(pattern)
+            if id(pattern) in self.left_recursive:
+                body_name = function_name + "_body"
+                self.functions.append(
+                    ["def %s(text, pos, name):" % body_name] + _indent(lines))
+                lines = ["return grow_seed(%s, %s, text, pos, name)" % (
+                    self.constant({}), body_name)]
+            self.functions.append(
+                ["def %s(text, pos, name):" % function_name] +
+                _indent(lines))
+        return (root, "\n\n".join("\n".join(f) for f in self.functions))
+
+    def test(self, pattern):
+        "An expression that is true if pattern matches at pos"
+        pattern, name = resolve(pattern, "")
+        if type(pattern) is pegger.Text:
+            return "text.startswith(%s, pos)" % self.constant(pattern.pattern)
+        elif type(pattern) is pegger.OneOf:
+            options = [resolve(option, "")[0] for option in pattern.options]
+            if options and all(type(o) is pegger.Text for o in options):
+                texts = tuple(o.pattern for o in options)
+                return "text.startswith(%s, pos)" % self.constant(texts)
+        if self.regex:
+            try:
+                regex, nullable = regex_for(pattern)
+            except NotRegular:
+                pass
+            else:
+                return self.match_regex(regex)
+        return "%s(text, pos, '') is not None" % self.function_for(pattern)
+
+    def inline(self, pattern, name=""):
+        "Get the Inline for matching pattern with name"
+        pattern, name = resolve(pattern, name)
+        fused = self.fuse(pattern, name)
+        if fused:
+            return fused
+        elif type(pattern) is pegger.Ignore:
+            inline = self.inline(pattern.pattern)
+            inline.kind = "ignore"
+            return inline
+        elif isinstance(name, basestring) and (type(pattern) in self.terminals):
+            return self.inline_leaf(pattern, name)
+        return Inline(
+            "call",
+            ["r = %s(text, pos, %s)" % (
+                self.function_for(pattern), self.constant(name))],
+            "r is not None", "r[2]", rest="r[1]")
+
+    def fuse(self, pattern, name):
+        """Get an Inline that matches pattern with a single regular
+        expression, or None if that isn't possible"""
+        if not (self.regex and isinstance(name, basestring)):
+            return None
+        kind = type(pattern)
+        try:
+            if (kind is pegger.Join) and is_flat(pattern.pattern):
+                regex, nullable = regex_for(pattern.pattern)
+                if nullable:
+                    return None
+                return self.regex_inline("leaf", regex, name, "found.group()")
+            elif (kind is pegger.Ignore) and (type(pattern.pattern) is not pegger.Text):
+                regex, nullable = regex_for(pattern.pattern)
+                return self.regex_inline("ignore", regex)
+            elif (kind is pegger.Many) and all(
+                    _is_character(option) for option in pattern.options):
+                regex, nullable = regex_for(pattern)
+                return self.regex_inline("chars", regex, name, "found.group()")
+        except NotRegular:
+            pass
+        return None
+
+    def match_regex(self, regex, line_safe=False):
+        "An expression that matches regex at pos, in a str or an IndentedText"
+        regex = self.constant(regex)
+        return ("(%s.match(text, pos) if type(text) is not IndentedText "
+                "else text.match(%s, pos, %s))" % (regex, regex, line_safe))
+
+    def regex_inline(self, kind, regex, name=None, value=None, line_safe=False):
+        return Inline(
+            kind,
+            ["found = %s" % self.match_regex(regex, line_safe)],
+            "found is not None", "found.end()",
+            name=name, value=value)
+
+    def inline_leaf(self, pattern, name):
+        "Get the Inline for a terminal pattern"
+        if isinstance(pattern, pegger.Text):
+            return Inline(
+                "leaf", [],
+                "text.startswith(%s, pos)" % self.constant(pattern.pattern),
+                "pos + %s" % len(pattern.pattern),
+                name=name, value=self.constant(pattern.pattern),
+                nonempty=bool(pattern.pattern))
+        elif isinstance(pattern, (pegger.Some, pegger.Words)):
+            if not pattern.scanner:
+                return Inline("leaf", [], "False", "pos", name=name)
+            return self.regex_inline(
+                "leaf", pattern.scanner, name, "found.group()", line_safe=True)
+        elif isinstance(pattern, pegger.Not):
+            return Inline(
+                "leaf", [],
+                "(pos < len(text)) and not (%s)" % self.test(pattern.pattern),
+                "pos + 1",
+                name=name, value="text[pos]")
+        elif isinstance(pattern, pegger.Insert):
+            return Inline(
+                "leaf", [], "True", "pos",
+                name=name, value=self.constant(pattern.text),
+                nonempty=bool(pattern.text))
+        elif isinstance(pattern, pegger.EOF):
+            return Inline(
+                "leaf", [], "pos >= len(text)", "pos",
+                name=name, value="''", nonempty=False)
+
+    def match(self, inline, name=None):
+        """An expression for the match of an inline, optionally with
+        the name given by another expression"""
+        if name is None:
+            name = self.constant(inline.name)
+        if inline.kind == "leaf":
+            return "[%s, %s]" % (name, inline.value)
+        elif inline.kind == "chars":
+            return "[%s] + list(%s)" % (name, inline.value)
+        elif inline.kind == "ignore":
+            return "[]"
+        else:
+            return "r[0]"
+
+    def add(self, inline, check):
+        """The lines that add the match of inline to result
+
+        check is "if" if only non-empty matches are added, "deep" if
+        only matches that contain some text are added, and "always" if
+        the match is always added."""
+        if inline.kind == "leaf":
+            if (check == "deep") and not (inline.name or inline.nonempty):
+                return []
+            if _is_transparent(inline.name):
+                return ["result.append(%s)" % inline.value]
+            return ["result.append(%s)" % self.match(inline)]
+        elif inline.kind == "chars":
+            if _is_transparent(inline.name):
+                return ["result.extend(%s)" % inline.value]
+            return ["result.append(%s)" % self.match(inline)]
+        elif inline.kind == "ignore":
+            if check == "always":
+                return ["_add(result, [])"]
+            return []
+        elif check == "if":
+            return ["if r[0]:", "    _add(result, r[0])"]
+        elif check == "deep":
+            return ["if has_text(r[0]):", "    _add(result, r[0])"]
+        else:
+            return ["_add(result, r[0])"]
+
+    def function_body(self, pattern):
+        "The lines of the function that matches pattern"
+        fused = self.fuse(pattern, "")
+        if fused:
+            return self.body_inline(fused)
+        method = self.bodies.get(type(pattern), "body_fallback")
+        return getattr(self, method)(pattern)
+
+    def body_inline(self, inline):
+        return inline.lines + [
+            "if %s:" % inline.condition,
+            "    return (%s, %s, %s)" % (
+                self.match(inline, "name"), inline.rest, inline.end),
+            "return None"]
+
+    def body_terminal(self, pattern):
+        return self.body_inline(self.inline_leaf(pattern, ""))
+
+    def body_NamedPattern(self, pattern):
+        return ["return %s(text, pos, %s)" % (
+            self.function_for(pattern.pattern), self.constant(pattern.name))]
+
+    def body_Lazy(self, pattern):
+        return ["return %s(text, pos, name or %s)" % (
+            self.function_for(pattern.resolve()), self.constant(pattern.name))]
+
+    def body_Ignore(self, pattern):
+        inline = self.inline(pattern.pattern)
+        return inline.lines + [
+            "if %s:" % inline.condition,
+            "    return ([], %s, %s)" % (inline.rest, inline.end),
+            "return None"]
+
+    def body_Optional(self, pattern):
+        inline = self.inline(pattern.pattern)
+        return inline.lines + [
+            "if %s:" % inline.condition,
+            "    return (%s, %s, %s)" % (
+                self.match(inline), inline.rest, inline.end),
+            "return ([], text, pos)"]
+
+    def body_AllOf(self, pattern):
+        lines = ["result = [name]"]
+        for option in pattern.options:
+            inline = self.inline(option)
+            lines.extend(inline.lines)
+            lines.append("if %s:" % inline.failed())
+            lines.append("    return None")
+            lines.extend(self.add(inline, "if"))
+            lines.extend(inline.advance())
+        lines.extend([
+            "if len(result) == 1:",
+            "    result.append('')",
+            "return (result, text, pos)"])
+        return lines
+
+    def body_OneOf(self, pattern):
+        lines = []
+        for option in pattern.options:
+            inline = self.inline(option)
+            lines.extend(inline.lines)
+            lines.append("if %s:" % inline.condition)
+            if inline.kind == "leaf":
+                if not (inline.name or inline.nonempty):
+                    result = "[name, '']"
+                elif _is_transparent(inline.name):
+                    result = "[name, %s]" % inline.value
+                else:
+                    result = "[name, %s]" % self.match(inline)
+                lines.append("    return (%s, text, %s)" % (result, inline.end))
+            elif inline.kind == "chars":
+                if _is_transparent(inline.name):
+                    result = "[name] + list(%s)" % inline.value
+                else:
+                    result = "[name, %s]" % self.match(inline)
+                lines.append("    return (%s, text, %s)" % (result, inline.end))
+            elif inline.kind == "ignore":
+                lines.append("    return ([name, ''], %s, %s)" % (
+                    inline.rest, inline.end))
+            else:
+                lines.extend(_indent([
+                    "result = [name]",
+                    "if has_text(r[0]):",
+                    "    _add(result, r[0])",
+                    "else:",
+                    "    result.append('')",
+                    "return (result, r[1], r[2])"]))
+        lines.append("return None")
+        return lines
+
+    def body_Many(self, pattern):
+        lines = [
+            "result = [name]",
+            "match_made = False",
+            "while pos < len(text):"]
+        for option in pattern.options:
+            inline = self.inline(option)
+            lines.extend(_indent(inline.lines))
+            lines.append("    if %s:" % inline.condition)
+            lines.extend(_indent(self.add(inline, "deep"), 2))
+            lines.extend(_indent(inline.advance(), 2))
+            lines.append("        match_made = True")
+            lines.append("        continue")
+        lines.extend([
+            "    break",
+            "if not match_made:",
+            "    return None",
+            "if len(result) == 1:",
+            "    result.append('')",
+            "return (result, text, pos)"])
+        return lines
+
+    def body_CountOf(self, pattern):
+        inline = self.inline(pattern.pattern)
+        return [
+            "result = [name]",
+            "for i in range(%s):" % pattern.count] + _indent(
+            inline.lines + [
+                "if %s:" % inline.failed(),
+                "    return None"] +
+            self.add(inline, "if") +
+            inline.advance()) + [
+            "return (result, text, pos)"]
+
+    def body_Join(self, pattern):
+        inline = self.inline(pattern.pattern)
+        return inline.lines + [
+            "if %s:" % inline.failed(),
+            "    return None",
+            "result = [name]"] + self.add(inline, "always") + [
+            "return (filter_match(result), %s, %s)" % (inline.rest, inline.end)]
+
+    def body_Escaped(self, pattern):
+        inline = self.inline(pattern.pattern)
+        return inline.lines + [
+            "if %s:" % inline.failed(),
+            "    return None",
+            "result = [name]",
+            "_add(result, do_escape(%s))" % self.match(inline),
+            "return (result, %s, %s)" % (inline.rest, inline.end)]
+
+    def body_fallback(self, pattern):
+        if type(pattern) in (pegger.Indented, pegger.Lookahead, pegger.Deferred):
+            # Use the interpreter, but with a compiled sub-pattern
+            original = pattern
+            pattern = copy.copy(original)
+            self.fixups.append(
+                (pattern, original.pattern, self.function_for(original.pattern)))
+        return [
+            "return %s.match_at(text, pos, name)" % self.constant(pattern)]
+
+    def build(self, pattern):
+        "Compile pattern into a Compiled pattern"
+        root, source = self.compile(pattern)
+        namespace = dict(self.namespace)
+        exec source in namespace
+        for copied, original, function_name in self.fixups:
+            copied.pattern = Compiled(original, namespace[function_name])
+        return Compiled(pattern, namespace[root], source)
+
+def compile(pattern, regex=False):
+    """Compile pattern into a pattern that matches the same text, and
+    gives the same result, but that runs as specialised Python code
+
+    If regex is true, parts of the grammar that are regular, and whose
+    results can be rebuilt from the text they match, are matched with
+    a single regular expression."""
+    return Compiler(regex).build(pegger._as_pattern(pattern))
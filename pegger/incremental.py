@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Incremental parsing
+
+`parse` matches a pattern against a text, and keeps what it matched
+along with how far into the text it looked to get it.  `reparse` takes
+an edit to the text and matches the new text, reusing the matches that
+didn't look at the part that was edited, moved to where they are in
+the new text.
+
+If the pattern is a Many, or a NamedPattern of a Many, as most
+document grammars are, only the match of each of its blocks is kept.
+The blocks before the edit are reused as they are, the blocks from the
+edit onwards are matched again until one ends where an old block
+started, and the old blocks from there on are reused.  So a reparse
+matches about as much text as the edit touched, and the memory kept is
+a tuple per block.
+
+For any other pattern the result of every pattern at every position is
+kept, and a reparse looks each of them up again.  That takes a good
+part of the time of a full parse, and keeps a dict entry for every
+pattern tried at every position, which is many times the size of the
+text.
+
+Results are only kept for patterns matched against the text itself, so
+the patterns inside an `Indented` are matched again whenever the
+`Indented` is."""
+
+import bisect
+import functools
+import itertools
+
+import pegger
+
+
+def examined_by(pattern, text, pos, result):
+    """How far into text pattern could have looked to get result,
+    not counting the patterns that it used"""
+    if result is None:
+        end = pos
+    elif result[1] is not text:
+        # The text was rewritten, eg by a Lookahead
+        return len(text) + 1
+    else:
+        end = result[2]
+    kind = type(pattern)
+    if kind is pegger.Text:
+        return max(end, pos + len(pattern.pattern))
+    elif kind in (pegger.Some, pegger.Words, pegger.Not, pegger.EOF, pegger.Many):
+        # These look at the character after their match, or check
+        # for the end of the text
+        return end + 1
+    elif kind is pegger.OneOf:
+        # It chose which options to try by the next character
+        return max(end, pos + 1)
+    elif kind is pegger.Until:
+        # It found the prefix of its pattern after its match
+        return end + max(len(pattern.prefix or ""), 1)
+    elif kind is pegger.Indented:
+        return _indented_examined(pattern, text, pos)
+    elif (kind is pegger.Deferred) and (pattern.span is None):
+        # It looked for the end of the line
+        return end + 1
+    elif kind in (pegger.AllOf, pegger.Optional, pegger.Ignore,
+                  pegger.Join, pegger.NamedPattern, pegger.Lazy, pegger.CountOf,
+                  pegger.Escaped, pegger.Insert, pegger.Deferred):
+        return end
+    # Anything else (eg a Lookahead, Function or compiled pattern)
+    # could have looked anywhere
+    return len(text) + 1
+
+def _indented_examined(pattern, text, pos):
+    "How far an Indented looked for the lines of its block"
+    indentation = pegger._get_indentation_at(text, pos, pattern)
+    if indentation is None:
+        return pos + 1
+    indent, length = indentation
+    if (not indent) and (not pattern.optional):
+        # It only looked at the indentation
+        return pos + (length or 0) + 1
+    spans = pegger._get_indented_spans(text, pos, indent, length)
+    start = spans[-1][1] + 1 if spans else pos
+    # The block ends at the first line after any blank lines that
+    # isn't indented, which had to be found to know it wasn't
+    while text.startswith("\n", start):
+        start = start + 1
+    end = text.find("\n", start)
+    if end == -1:
+        end = len(text)
+    return end + 1
+
+
+class Parse(object):
+    """The match of pattern against text, and the results found on the
+    way
+
+    If previous is given, it is the Parse of the text before edit,
+    which is `(start, old_end, new_end)`, and its results are reused
+    where they can be."""
+    def __init__(self, text, pattern, previous=None, edit=None):
+        self.text = text
+        self.pattern = pegger._as_pattern(pattern)
+        self.previous = previous
+        self.edit = edit
+        self.results = {}
+        # For a Many, the (start, end, examined, items) of each of its
+        # blocks, ending with the position where it stopped, along
+        # with the starts and the furthest examined so far of each
+        self.blocks = None
+        self.starts = None
+        self.reach = None
+        self.stack = []
+        self.match = None
+        self.reused = 0
+
+    def run(self):
+        "Match the pattern, and return self"
+        try:
+            grammar = pegger.wrap_grammar(self.pattern, self.wrap)
+            many = grammar.pattern if type(grammar) is pegger.NamedPattern else grammar
+            if type(many) is pegger.Many:
+                result = self.run_blocks(many, getattr(grammar, "name", ""))
+            else:
+                result = grammar.match_at(self.text, 0)
+        finally:
+            # Results that weren't needed this time are let go
+            self.previous = None
+        if result is None:
+            raise pegger.NoPatternFound
+        self.match = result[0]
+        return self
+
+    def run_blocks(self, many, name):
+        "Match the blocks of many, reusing the blocks of previous"
+        text = self.text
+        self.blocks, self.starts, self.reach = [], [], []
+        previous = self.previous
+        if (previous is not None) and (previous.blocks is None):
+            previous = None
+        pos = 0
+        if previous is not None:
+            start, old_end, new_end = self.edit
+            shift = new_end - old_end
+            # The blocks that didn't look as far as the edit are kept,
+            # but the Many is tried again where it stopped
+            kept = min(bisect.bisect_right(previous.reach, start), len(previous.blocks) - 1)
+            if kept:
+                self.add_blocks(previous, 0, kept, 0)
+                pos = self.blocks[-1][1]
+        while True:
+            if (previous is not None) and (pos >= new_end):
+                old = bisect.bisect_left(previous.starts, pos - shift)
+                if (old < len(previous.starts)) and (previous.starts[old] == pos - shift):
+                    # The rest of the text is as it was from here on
+                    self.add_blocks(previous, old, len(previous.blocks), shift)
+                    break
+            self.stack.append(pos)
+            result = None
+            if pos < len(text):
+                table, default = many.dispatch or ({}, many.options)
+                for option in table.get(text[pos], default):
+                    result = option.match_at(text, pos)
+                    if result is not None:
+                        break
+            examined = max(self.stack.pop(), pos + 1)
+            if result is None:
+                self.add_block(pos, pos, examined, None)
+                break
+            match, rest, end = result
+            if rest is not text:
+                # The text was rewritten, eg by a Lookahead, so the
+                # rest of it can't be split into blocks
+                self.blocks = self.starts = self.reach = None
+                return many.match_at(text, 0, name)
+            items = []
+            if pegger._has_text(match):
+                pegger._add_match_to_result(items, match)
+            self.add_block(pos, end, examined, items)
+            pos = end
+        if len(self.blocks) == 1:
+            return None
+        result = [name]
+        result.extend(itertools.chain.from_iterable(block[3] for block in self.blocks[:-1]))
+        if result == [name]:
+            result.append("")
+        return (result, text, self.blocks[-1][0])
+
+    def add_block(self, start, end, examined, items):
+        self.blocks.append((start, end, examined, items))
+        self.starts.append(start)
+        self.reach.append(max(examined, self.reach[-1]) if self.reach else examined)
+
+    def add_blocks(self, previous, first, last, shift):
+        "Reuse the blocks of previous from first to last, moved by shift"
+        blocks = previous.blocks[first:last]
+        if shift:
+            blocks = [(start + shift, end + shift, examined + shift, items)
+                      for start, end, examined, items in blocks]
+        reach = self.reach[-1] if self.reach else 0
+        self.blocks.extend(blocks)
+        self.starts.extend(block[0] for block in blocks)
+        self.reach.extend(max(reach, examined + shift) for examined in previous.reach[first:last])
+        self.reused += last - first
+
+    def lookup(self, pos, key):
+        "Get the (result, examined) for key at pos, if it is known"
+        try:
+            return self.results[pos][key]
+        except KeyError:
+            pass
+        if self.previous is None:
+            return None
+        start, old_end, new_end = self.edit
+        if pos < start:
+            old_pos = pos
+            shift = 0
+        elif pos >= new_end:
+            old_pos = pos - new_end + old_end
+            shift = new_end - old_end
+        else:
+            return None
+        entry = self.previous.lookup(old_pos, key)
+        if entry is None:
+            return None
+        result, examined = entry
+        if (old_pos < start) and (examined > start):
+            # It looked at the text that was edited
+            return None
+        if result is not None:
+            match, rest, end = result
+            result = (match, self.text, end + shift)
+        entry = self.results.setdefault(pos, {})[key] = (result, examined + shift)
+        self.reused += 1
+        return entry
+
+    def wrap(self, match_at):
+        "Wrap a match_at so that it uses and fills in the results"
+        @functools.wraps(match_at)
+        def tracked(pattern, text, pos, name=""):
+            if text is not self.text:
+                return match_at(pattern, text, pos, name)
+            # Each parse has its own copy of the grammar
+            key = (pattern.original, name)
+            growing = pegger._growing_seeds and ((id(text), pos) in pegger._growing_seeds)
+            keep = self.blocks is None
+            entry = keep and (not growing) and self.lookup(pos, key)
+            if entry:
+                result, examined = entry
+            else:
+                self.stack.append(pos)
+                try:
+                    result = match_at(pattern, text, pos, name)
+                finally:
+                    examined = self.stack.pop()
+                examined = max(examined, examined_by(pattern, text, pos, result))
+                if keep and not (pegger._growing_seeds and ((id(text), pos) in pegger._growing_seeds)):
+                    self.results.setdefault(pos, {})[key] = (result, examined)
+            if self.stack and (examined > self.stack[-1]):
+                self.stack[-1] = examined
+            return result
+        return tracked
+
+def parse(text, pattern):
+    "Match pattern against text, keeping what is needed to reparse it"
+    return Parse(text, pattern).run()
+
+def reparse(parsed, edit):
+    """Match the pattern of parsed against its text after edit, which
+    is `(start, old_end, new_text)`, reusing what it can"""
+    start, old_end, new_text = edit
+    text = parsed.text[:start] + new_text + parsed.text[old_end:]
+    new_end = start + len(new_text)
+    return Parse(text, parsed.pattern, parsed, (start, old_end, new_end)).run()
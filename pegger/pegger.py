@@ -1,29 +1,91 @@
 # -*- coding: utf-8 -*-
 
+import re
+import bisect
+import copy
+import types
+import mmap
+import multiprocessing
 import string
 import cgi
 import functools
+import collections
 
 import utils
+import tree
+import analysis
 
 
 class NoPatternFound(Exception):
     pass
 
+class GrammarError(Exception):
+    "The grammar can't work, eg it has a Many that would never stop"
+
+class GrammarWarning(UserWarning):
+    "Part of the grammar can never match"
+
 class BasePatternCreator(object):
+    """The base of all patterns
+
+    Patterns match against a position in a text with
+    `match_at(text, pos, name)`, which returns `(match, text, end)`,
+    or None if the pattern doesn't match.  The text is returned
+    because a few patterns (eg `Lookahead`) have to hand on a
+    different text to the patterns that follow them, but for
+    everything else it is the text that was passed in, and the rest of
+    the text is `text[end:]`.
+
+    Calling a pattern with `(text, name)` gives the older
+    `(match, rest)` protocol, which raises NoPatternFound if the
+    pattern doesn't match."""
     def __call__(self, text, name=""):
         return self.match(text, name)
 
+    def match(self, text, name=""):
+        result = self.match_at(text, 0, name)
+        if result is None:
+            raise NoPatternFound
+        match, text, end = result
+        return (match, text[end:])
+
     def __repr__(self):
         return "<%s>" % (self.__class__.__name__)
 
 
+class Function(BasePatternCreator):
+    """Wrap a callable that uses the `(match, rest)` protocol"""
+    def __init__(self, func):
+        self.func = func
+
+    def match_at(self, text, pos, name=""):
+        try:
+            if name:
+                match, rest = self.func(text[pos:], name)
+            else:
+                match, rest = self.func(text[pos:])
+        except NoPatternFound:
+            return None
+        return (match, rest, 0)
+
+    def __repr__(self):
+        return "<%s func=%r>" % (self.__class__.__name__, self.func)
+
+
+def _as_pattern(pattern):
+    "Turn strings and plain callables into patterns"
+    if isinstance(pattern, basestring):
+        return Text(pattern)
+    elif (pattern is None) or isinstance(pattern, BasePatternCreator):
+        return pattern
+    else:
+        return Function(pattern)
+
+
 class PatternCreator(BasePatternCreator):
     """A pattern creator"""
     def __init__(self, pattern):
-        if isinstance(pattern, basestring):
-            pattern = Text(pattern)
-        self.pattern = pattern
+        self.pattern = _as_pattern(pattern)
 
     def __repr__(self):
         return "<%s pattern=%r>" % (self.__class__.__name__, self.pattern)
@@ -41,12 +103,7 @@ class TextPatternCreator(BasePatternCreator):
 class OptionsPatternCreator(BasePatternCreator):
     """A pattern creator with a list of options"""
     def __init__(self, *options):
-        processed_options = []
-        for option in options:
-            if isinstance(option, basestring):
-                option = Text(option)
-            processed_options.append(option)
-        self.options = tuple(processed_options)
+        self.options = tuple(_as_pattern(option) for option in options)
 
     def __repr__(self):
         return "<%s options=%r>" % (self.__class__.__name__, self.options)
@@ -54,143 +111,273 @@ class OptionsPatternCreator(BasePatternCreator):
 
 class Some(TextPatternCreator):
     """Match the given char repeatedly"""
-    def match(self, text, name=""):
-        match = []
-        rest = list(text)
-        while rest:
-            char = rest[0]
-            if self.pattern == char:
-                match.append(rest.pop(0))
+    def __init__(self, pattern):
+        self.pattern = pattern
+        if len(pattern) == 1:
+            self.scanner = re.compile(re.escape(pattern) + "+")
+        else:
+            self.scanner = None
+
+    def match_at(self, text, pos, name=""):
+        if not self.scanner:
+            return None
+        found = match_regex(self.scanner, text, pos, True)
+        if not found:
+            return None
+        return ([name, found.group()], text, found.end())
+
+
+class CharClass(object):
+    """A set of characters, given by a spec like "a-zA-Z_"
+
+    A "-" between two characters gives the range between them, and a
+    "^" at the start gives every character except the ones in the
+    rest of the spec.  A spec of just "^" is the "^" character."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.negated = spec.startswith("^") and (len(spec) > 1)
+        if self.negated:
+            spec = spec[1:]
+        chars = []
+        self.ranges = []
+        i = 0
+        while i < len(spec):
+            if (i + 2 < len(spec)) and (spec[i+1] == "-"):
+                self.ranges.append((spec[i], spec[i+2]))
+                i = i + 3
             else:
-                break
-        if not match:
-            raise NoPatternFound
-        return ([name, "".join(match)], "".join(rest))
+                chars.append(spec[i])
+                i = i + 1
+        self.chars = frozenset(chars)
+
+    def __contains__(self, char):
+        found = (char in self.chars) or any(
+            start <= char <= end for start, end in self.ranges)
+        return found != self.negated
+
+    def regex(self):
+        "A regular expression character class for the characters"
+        # re.escape escapes the "^", "]", "\\" and "-" that are special here
+        body = "".join(re.escape(char) for char in sorted(self.chars)) + "".join(
+            "%s-%s" % (re.escape(start), re.escape(end)) for start, end in self.ranges)
+        if not body:
+            # "[]" isn't a valid class, so use one that matches nothing
+            return "[^\\s\\S]"
+        return "[%s%s]" % ("^" if self.negated else "", body)
+
+    def __repr__(self):
+        return "<%s spec=%r>" % (self.__class__.__name__, self.spec)
+
+def _character_class(letters):
+    "A regular expression that matches any of letters"
+    if isinstance(letters, CharClass):
+        return letters.regex()
+    return "[%s]" % "".join(re.escape(letter) for letter in sorted(set(letters)))
 
 
 class Words(PatternCreator):
-    "Match everything that is part of pattern.letters"
+    """Match everything that is part of pattern.letters
+
+    letters can be a string of the letters, or a CharClass."""
     letters = string.uppercase + string.lowercase + " .,"
 
     def __init__(self, letters=None):
         if letters:
             self.letters = letters
+        self.scanner = re.compile(_character_class(self.letters) + "+")
 
     def __repr__(self):
         return "<%s letters=%r>" % (self.__class__.__name__, self.letters)
 
-    def match(self, text, name):
-        match = []
-        rest = list(text)
-        while rest:
-            char = rest[0]
-            if char in self.letters:
-                match.append(rest.pop(0))
-            else:
-                break
-        if not match:
-            raise NoPatternFound
-        return ([name, "".join(match)], "".join(rest))
-
+    def match_at(self, text, pos, name=""):
+        found = match_regex(self.scanner, text, pos, True)
+        if not found:
+            return None
+        return ([name, found.group()], text, found.end())
 
 
 class Text(TextPatternCreator):
     """If the pattern matches the beginning of the text, parser it and
     return the rest"""
-    def match(self, text, name):
-        if text.startswith(self.pattern):
-            rest = text[len(self.pattern):]
-            return ([name, self.pattern], rest)
+    def match_at(self, text, pos, name=""):
+        if text.startswith(self.pattern, pos):
+            return ([name, self.pattern], text, pos + len(self.pattern))
         else:
-            raise NoPatternFound
+            return None
 
 
 class NamedPattern(PatternCreator):
     """A pattern with a name"""
     def __init__(self, name, pattern):
         self.name = name
-        if isinstance(pattern, basestring):
-            pattern = Text(pattern)
-        self.pattern = pattern
+        self.pattern = _as_pattern(pattern)
 
     def __call__(self, text):
-        return self.pattern(text, self.name)
+        return self.match(text)
+
+    def match_at(self, text, pos, name=""):
+        return self.pattern.match_at(text, pos, self.name)
 
 
 class Ignore(PatternCreator):
     "Match the pattern, but return no result"
-    def match(self, text, name):
-        try:
-            match, rest = self.pattern(text)
-            return ([], rest)
-        except NoPatternFound:
-            raise NoPatternFound
+    def match_at(self, text, pos, name=""):
+        result = self.pattern.match_at(text, pos)
+        if result is None:
+            return None
+        match, text, pos = result
+        return ([], text, pos)
 
 
 class AllOf(OptionsPatternCreator):
     "Match each of the patterns in pattern"
-    def match(self, text, name):
+    def match_at(self, text, pos, name=""):
         result = [name]
-        rest = text
         for sub_pattern in self.options:
-            match, rest = sub_pattern(rest)
+            sub_result = sub_pattern.match_at(text, pos)
+            if sub_result is None:
+                return None
+            match, text, pos = sub_result
             if match:
                 _add_match_to_result(result, match)
         if result == [name]:
             result.append("")
-        return (result, rest)
+        return (result, text, pos)
 
 
 class OneOf(OptionsPatternCreator):
-    """Match one of the patterns given"""
-    def match(self, text, name):
-        for sub_pattern in self.options:
-            try:
-                match, rest = sub_pattern(text)
-                result = [name]
-                if utils.deep_bool(match):
-                    _add_match_to_result(result, match)
-                else:
-                    result.append("")
-                return (result, rest)
-            except NoPatternFound:
+    """Match one of the patterns given
+
+    Only the options that could start with the next character are
+    tried, using a dispatch table from analysis that is built the
+    first time it matches."""
+    dispatch = None
+
+    def match_at(self, text, pos, name=""):
+        dispatch = self.dispatch
+        if dispatch is None:
+            analysis.Analysis(self).mark()
+            dispatch = self.dispatch
+        if dispatch:
+            table, options = dispatch
+            if pos < len(text):
+                options = table.get(text[pos], options)
+        else:
+            options = self.options
+        for sub_pattern in options:
+            sub_result = sub_pattern.match_at(text, pos)
+            if sub_result is None:
                 continue
-        raise NoPatternFound
+            match, rest, end = sub_result
+            result = [name]
+            if _has_text(match):
+                _add_match_to_result(result, match)
+            else:
+                result.append("")
+            return (result, rest, end)
+        return None
+
+
+class Lazy(BasePatternCreator):
+    """A pattern that is built by calling func the first time it is
+    needed, so that it can refer to itself, or to patterns that are
+    defined after it
+
+    If the pattern can call itself without moving on (ie it is left
+    recursive) its matches are grown from a seed."""
+    left_recursive = None
+
+    def __init__(self, func):
+        self.func = func
+        self.pattern = None
+        self.name = func.__name__
+        if self.name == "<lambda>":
+            self.name = ""
+        self.seeds = {}
+        functools.update_wrapper(self, func)
+
+    def resolve(self):
+        "Build the pattern if it hasn't been built yet"
+        if self.pattern is None:
+            self.pattern = _as_pattern(self.func())
+        return self.pattern
+
+    def match_at(self, text, pos, name=""):
+        pattern = self.pattern or self.resolve()
+        if self.left_recursive is None:
+            analysis.Analysis(self).mark()
+        if self.left_recursive is False:
+            return pattern.match_at(text, pos, name or self.name)
+        return _grow_seed(self.seeds, pattern.match_at, text, pos, name or self.name)
+
+    def __repr__(self):
+        return "<%s func=%r>" % (self.__class__.__name__, self.func)
+
+# The (id(text), pos) of the left recursive rules that are growing
+_growing_seeds = collections.defaultdict(int)
+
+def _grow_seed(seeds, match_at, text, pos, name):
+    """Call match_at, allowing it to be left recursive
+
+    seeds holds the rule's matches that are in progress.  If the rule
+    calls itself at the same position, the inner call gets the seed
+    (at first a failure) instead of recursing forever.  The rule is
+    then matched again with each new seed, until the match stops
+    getting longer, which gives a left associative match.
+
+    The seed is the rule's match at the position, whatever name it is
+    called with, so an inner call with another name (eg through a
+    NamedPattern) gets the seed with its own name."""
+    key = (id(text), pos)
+    seed = seeds.get(key)
+    if seed is not None:
+        if not seed[1]:
+            seed[1] = True
+            _growing_seeds[key] += 1
+        result = seed[0]
+        if (result is not None) and (name != seed[2]) and (result[0][:1] == [seed[2]]):
+            result = ([name] + result[0][1:], result[1], result[2])
+        return result
+    seed = seeds[key] = [None, False, name]
+    try:
+        result = match_at(text, pos, name)
+        if seed[1]:
+            while result is not None:
+                seed[0] = result
+                grown = match_at(text, pos, name)
+                if (grown is None) or (grown[1] is not result[1]) or (grown[2] <= result[2]):
+                    break
+                result = grown
+    finally:
+        del seeds[key]
+        if seed[1]:
+            _growing_seeds[key] -= 1
+            if not _growing_seeds[key]:
+                del _growing_seeds[key]
+    return result
 
 
 def lazy(func):
     """A decorator that allows a pattern to refer to itself"""
-    @functools.wraps(func)
-    def inner(text, name=''):
-        pattern = func()
-        if not name:
-            name = func.__name__
-            if name == "<lambda>":
-                name = ""
-        return pattern(text, name)
-    return inner
+    return Lazy(func)
 
 
 class CountOf(PatternCreator):
     """A matcher that matches count items"""
     def __init__(self, count, pattern):
         self.count = count
-        if isinstance(pattern, basestring):
-            pattern = Text(pattern)
-        self.pattern = pattern
+        self.pattern = _as_pattern(pattern)
 
-    def match(self, text, name):
+    def match_at(self, text, pos, name=""):
         result = [name]
-        rest = text
         for i in range(self.count):
-            try:
-                match, rest = self.pattern(rest)
-            except NoPatternFound:
-                raise NoPatternFound("Only %s of the given pattern were found" % i)
-            else:
-                if match:
-                    _add_match_to_result(result, match)
-        return (result, rest)
+            sub_result = self.pattern.match_at(text, pos)
+            if sub_result is None:
+                return None
+            match, text, pos = sub_result
+            if match:
+                _add_match_to_result(result, match)
+        return (result, text, pos)
 
 
 class Insert(PatternCreator):
@@ -198,8 +385,8 @@ class Insert(PatternCreator):
     def __init__(self, text):
         self.text = text
 
-    def match(self, text, name):
-        return ([name, self.text], text)
+    def match_at(self, text, pos, name=""):
+        return ([name, self.text], text, pos)
 
     def __repr__(self):
         return "<%s text=%r>" % (self.__class__.__name__, self.text)
@@ -207,34 +394,41 @@ class Insert(PatternCreator):
 
 class EOF(BasePatternCreator):
     """A matcher that matches the end of the string"""
-    def match(self, text, name):
-        if not text:
-            return ([name, ''], text)
+    def match_at(self, text, pos, name=""):
+        if pos >= len(text):
+            return ([name, ''], text, pos)
         else:
-            raise NoPatternFound("No EOF found")
+            return None
 
 
 class Join(PatternCreator):
-    def match(self, text, name):
-        try:
-            match, rest = self.pattern(text)
-        except NoPatternFound:
-            raise NoPatternFound
+    def match_at(self, text, pos, name=""):
+        sub_result = self.pattern.match_at(text, pos)
+        if sub_result is None:
+            return None
+        match, text, pos = sub_result
+        if match and _is_transparent(match[0]):
+            # Join the items of match straight into the result
+            return (filter_match(match, name=name), text, pos)
         result = [name]
         _add_match_to_result(result, match)
-        result = filter_match(result)
-        return (result, rest)
+        return (filter_match(result), text, pos)
+
+def filter_match(match, recursive=False, name=None):
+    """Concatenates consecutive characters
 
-def filter_match(match, recursive=False):
-    "Concatenates consecutive characters"
+    If name is given, it is used in place of the name of match.  Any
+    deferred matches are made, to get their text."""
     if match == []:
         return match
     result = []
-    result.append(match[0])
+    result.append(match[0] if name is None else name)
     submatches = []
     for item in match[1:]:
         if isinstance(item, basestring):
             submatches.append(item)
+        elif isinstance(item, DeferredMatch):
+            return filter_match(expand(match), recursive, name)
         else:
             if recursive:
                 submatches.append(filter_match(item, recursive=True)[1])
@@ -248,60 +442,124 @@ def filter_match(match, recursive=False):
 
 
 class Many(OptionsPatternCreator):
-    """Repeatedly match any of the given patterns"""
-    def match(self, text, name):
+    """Repeatedly match any of the given patterns
+
+    Like OneOf, only the options that could start with the next
+    character are tried."""
+    dispatch = None
+
+    def match_at(self, text, pos, name=""):
+        dispatch = self.dispatch
+        if dispatch is None:
+            analysis.Analysis(self).mark()
+            dispatch = self.dispatch
+        if dispatch:
+            table, default = dispatch
+        options = self.options
         result = [name]
-        rest = text
         match_made = False
-        while rest:
-            for sub_pattern in self.options:
-                try:
-                    match, rest = sub_pattern(rest)
-                    match_made = True
-                    if utils.deep_bool(match):
-                        _add_match_to_result(result, match)
-                    break
-                except NoPatternFound:
+        while pos < len(text):
+            if dispatch:
+                options = table.get(text[pos], default)
+            for sub_pattern in options:
+                sub_result = sub_pattern.match_at(text, pos)
+                if sub_result is None:
                     continue
+                match, text, pos = sub_result
+                match_made = True
+                if _has_text(match):
+                    _add_match_to_result(result, match)
+                break
             else:
                 break
         if not match_made:
-            raise NoPatternFound
+            return None
         else:
             if result == [name]:
                 result.append("")
-            return (result, rest)
+            return (result, text, pos)
 
 
 class Not(PatternCreator):
     """Match a character if text doesn't start with pattern"""
-    def match(self, text, name):
-        if not text:
-            raise NoPatternFound
-        try:
-            match, rest = self.pattern(text)
-        except NoPatternFound:
-            return ([name, text[0]], text[1:])
+    def match_at(self, text, pos, name=""):
+        if pos >= len(text):
+            return None
+        if self.pattern.match_at(text, pos) is None:
+            return ([name, text[pos]], text, pos + 1)
         else:
-            raise NoPatternFound
+            return None
+
+
+class Until(PatternCreator):
+    """Match the text up to where pattern matches, or to the end of the
+    text, as one string
+
+    This matches the same text as `Join(Many(Not(pattern)))`, but it
+    skips to where pattern could start with find, or a regex of the
+    characters it can start with, rather than trying it at every
+    character."""
+    prefix = None
+    scanner = None
+
+    def match_at(self, text, pos, name=""):
+        if self.prefix is None:
+            self.prefix = _required_prefix(self.pattern)
+            grammar = analysis.Analysis(self.pattern)
+            first = grammar.get_first(self.pattern)
+            if (not self.prefix) and (first is not analysis.ANY) and (
+                    not grammar.is_nullable(self.pattern)):
+                self.scanner = re.compile(
+                    "[%s]" % "".join(re.escape(char) for char in sorted(first)))
+        end = self.find(text, pos)
+        if end == pos:
+            return None
+        return ([name, text[pos:end]], text, end)
+
+    def find(self, text, pos):
+        "Find where pattern next matches in text, or the end of the text"
+        prefix = self.prefix
+        exact = type(self.pattern) is Text
+        scanner = self.scanner if type(text) is not IndentedText else None
+        length = len(text)
+        while pos < length:
+            if prefix:
+                pos = text.find(prefix, pos)
+                if pos == -1:
+                    return length
+                elif exact:
+                    return pos
+            elif scanner:
+                found = scanner.search(text, pos)
+                if found is None:
+                    return length
+                pos = found.start()
+            if self.pattern.match_at(text, pos) is not None:
+                return pos
+            pos = pos + 1
+        return length
 
 
 class Optional(PatternCreator):
     """A matcher that matches the pattern if it's available"""
-    def match(self, text, name):
+    def match_at(self, text, pos, name=""):
         """Match pattern if it's there"""
-        try:
-            return self.pattern(text)
-        except NoPatternFound:
-            return ([], text)
+        result = self.pattern.match_at(text, pos)
+        if result is None:
+            return ([], text, pos)
+        return result
 
-def _get_current_indentation(text, pattern=None):
-    "Finds the current number of spaces at the start"
+def _get_indentation_at(text, pos, pattern=None):
+    """Finds the indentation of the line starting at pos
+
+    Returns the indent and, if the pattern has an initial_indent, the
+    number of characters it matched, or None if the pattern's
+    initial_indent or indent_pattern doesn't match"""
     if pattern and pattern.initial_indent:
-        try:
-            match, rest = pattern.initial_indent(text)
-        except NoPatternFound:
-            raise NoPatternFound
+        result = pattern.initial_indent.match_at(text, pos)
+        if result is None:
+            return None
+        match, text, end = result
         match = filter_match(match, recursive=True)
         match = "".join(match[1:])
         if set(match) == set("\t"):
@@ -309,58 +567,341 @@ def _get_current_indentation(text, pattern=None):
         else:
             indent_type = " "
         indent = indent_type * len(match)
-        rest = indent + rest
-        return (indent, rest)
+        return (indent, end - pos)
     elif pattern and pattern.indent_pattern:
-        indent, rest = pattern.indent_pattern(text)
-        indent = indent[1]
-        return (indent, text)
+        result = pattern.indent_pattern.match_at(text, pos)
+        if result is None:
+            return None
+        indent = result[0][1]
+        return (indent, None)
     else:
         indent = ""
-        for char in text:
-            if char in [" ", "\t"]:
-                if (not indent) or (char in indent):
-                    indent = indent + char
-            else:
-                return (indent, text)
+        while (pos < len(text)) and (text[pos] in [" ", "\t"]):
+            if (not indent) or (text[pos] in indent):
+                indent = indent + text[pos]
+            pos = pos + 1
+        return (indent, None)
+
+def _get_current_indentation(text, pattern=None):
+    "Finds the current number of spaces at the start"
+    indentation = _get_indentation_at(text, 0, pattern)
+    if indentation is None:
+        raise NoPatternFound
+    indent, length = indentation
+    if length is not None:
+        return (indent, indent + text[length:])
+    else:
         return (indent, text)
 
 
 class Indented(PatternCreator):
-    """Remove indentation before matching"""
+    """Remove indentation before matching
+
+    The rest is the original text after the match, with its blank
+    lines as they were, rather than the unmatched indented lines with
+    the indent put back."""
     def __init__(self, pattern, optional=False, initial_indent=None, indent_pattern=None):
-        if isinstance(pattern, basestring):
-            pattern = Text(pattern)
-        if isinstance(indent_pattern, basestring):
-            indent_pattern = Text(indent_pattern)
-        if isinstance(initial_indent, basestring):
-            initial_indent = Text(initial_indent)
-        self.pattern = pattern
+        self.pattern = _as_pattern(pattern)
         self.optional = optional
-        self.initial_indent = initial_indent
-        self.indent_pattern = indent_pattern
-
-    def match(self, text, name):
-        indent, text = _get_current_indentation(text, self)
+        self.initial_indent = _as_pattern(initial_indent)
+        self.indent_pattern = _as_pattern(indent_pattern)
+
+    def match_at(self, text, pos, name=""):
+        indentation = _get_indentation_at(text, pos, self)
+        if indentation is None:
+            return None
+        indent, length = indentation
         if (not indent) and (not self.optional):
-            raise NoPatternFound
-        lines = text.split("\n")
-        indented_lines = _get_indented_lines(lines, indent)
-        other_lines = lines[len(indented_lines):]
-        indented_text = "\n".join(indented_lines)
-        try:
-            indented_match, indented_rest = self.pattern(indented_text)
-        except NoPatternFound:
-            raise NoPatternFound
-        indented_rest = indented_rest.replace("\n", "\n"+indent)
-        rest_lines = [line for line in indented_rest.split("\n")]
-        rest_lines = rest_lines + other_lines
-        rest = "\n".join(rest_lines)
+            return None
+        spans = _get_indented_spans(text, pos, indent, length) or [(pos, pos)]
+        if type(text) is IndentedText:
+            indented_text = text.select(spans, "\n")
+        else:
+            indented_text = IndentedText(text, spans)
+        indented_result = self.pattern.match_at(indented_text, 0)
+        if indented_result is None:
+            return None
+        indented_match, indented_rest, indented_end = indented_result
+        if indented_rest is indented_text:
+            end = indented_text.original_offset(indented_end)
+            if type(text) is IndentedText:
+                end = text.view_offset(end)
+        else:
+            # The indented text was rewritten (eg by a Lookahead), so
+            # the rest has to be reindented rather than found in text
+            indented_rest = indented_rest[indented_end:]
+            text = indented_rest.replace("\n", "\n"+indent) + text[spans[-1][1]:]
+            end = 0
         result = [name]
         _add_match_to_result(result, indented_match)
         if len(result) == 1:
             result = result[0]
-        return (result, rest)
+        return (result, text, end)
+
+def _get_indented_spans(text, pos, indent, length=None):
+    """Finds the lines from pos onwards that are indented by indent
+
+    Returns the (start, end) offsets of each line, without its indent.
+    If length is given, the first line is taken to be indented by
+    that many characters."""
+    spans = []
+    current_linebreak = []
+    start = pos
+    while start <= len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        if length is not None:
+            spans.append((start + length, end))
+            length = None
+        elif text.startswith(indent, start):
+            spans.extend(current_linebreak)
+            current_linebreak = []
+            spans.append((start + len(indent), end))
+        elif (start == end) and (not current_linebreak):
+            # if the line is blank but the previous line wasn't
+            current_linebreak.append((start, end))
+        else:
+            break
+        start = end + 1
+    return spans
+
+class IndentedText(object):
+    """The lines of a text with their indentation removed
+
+    spans are the (start, end) offsets in text of each line, without
+    its indent.  This looks like the lines joined with newlines, but
+    nothing is copied until it is sliced, and offsets in it can be
+    mapped back to the original text.
+
+    joins can give what each span is joined to the next by instead,
+    either "\\n" or "", which is how a `Lookahead` leaves out the text
+    it matched."""
+    def __init__(self, text, spans, joins=None):
+        self.text = text
+        self.spans = spans
+        self.joins = joins
+        self.starts = [start for start, end in spans]
+        self.offsets = []
+        offset = 0
+        for line, (start, end) in enumerate(spans):
+            self.offsets.append(offset)
+            offset = offset + (end - start) + len(self.join(line))
+        self.length = offset - len(self.join(len(spans) - 1))
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self[:])
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return self[:] == other
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def join(self, line):
+        "What the span line is joined to the next one by"
+        if line + 1 >= len(self.spans):
+            return ""
+        elif self.joins is None:
+            return "\n"
+        return self.joins[line]
+
+    def locate(self, pos):
+        "Find the line that pos is in, and its offset in the original text"
+        line = bisect.bisect_right(self.offsets, pos) - 1
+        return (line, self.spans[line][0] + pos - self.offsets[line])
+
+    def original_offset(self, pos):
+        "Maps an offset in the view back to the original text"
+        if not (0 <= pos <= self.length):
+            raise ValueError("Offset is outside the indented lines")
+        return self.locate(pos)[1]
+
+    def view_offset(self, offset):
+        "Maps an offset in the original text to the view"
+        line = bisect.bisect_right(self.starts, offset) - 1
+        start, end = self.spans[line]
+        if not (start <= offset <= end):
+            raise ValueError("Offset is not in the indented lines")
+        return self.offsets[line] + offset - start
+
+    def pieces(self, start, stop):
+        """The spans of the original text, and what they are joined
+        by, that make up the view between start and stop"""
+        spans = []
+        joins = []
+        line = self.locate(start)[0]
+        while True:
+            line_start, line_end = self.spans[line]
+            offset = self.offsets[line]
+            spans.append((
+                max(start, offset) - offset + line_start,
+                max(min(stop, offset + line_end - line_start), start) - offset + line_start))
+            if (line + 1 == len(self.spans)) or (self.offsets[line + 1] > stop):
+                return (spans, joins)
+            joins.append(self.join(line))
+            line = line + 1
+
+    def select(self, ranges, join):
+        """A view of the text between each (start, stop) in ranges,
+        joined by join, without copying it"""
+        spans = []
+        joins = []
+        for start, stop in ranges:
+            if spans:
+                joins.append(join)
+            range_spans, range_joins = self.pieces(start, stop)
+            spans.extend(range_spans)
+            joins.extend(range_joins)
+        # Join up the spans that are next to each other, and leave out
+        # the empty ones, except where they end at a newline
+        joined_spans = spans[:1]
+        joined_joins = []
+        for line, span in enumerate(spans[1:]):
+            if joins[line] == "":
+                last = joined_spans[-1]
+                if last[1] == span[0]:
+                    joined_spans[-1] = (last[0], span[1])
+                    continue
+                elif (span[0] == span[1]) and (joins[line + 1:line + 2] != ["\n"]):
+                    continue
+                elif last[0] == last[1]:
+                    joined_spans[-1] = span
+                    continue
+            joined_joins.append(joins[line])
+            joined_spans.append(span)
+        if (join == "\n") and all(join == "\n" for join in joined_joins):
+            joined_joins = None
+        return IndentedText(self.text, joined_spans, joined_joins)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return self[start:stop][::step]
+            return self.slice(start, stop)
+        if index < 0:
+            index = index + self.length
+        if not (0 <= index < self.length):
+            raise IndexError("IndentedText index out of range")
+        line, offset = self.locate(index)
+        if offset < self.spans[line][1]:
+            return self.text[offset]
+        return self.join(line)
+
+    def slice(self, start, stop):
+        "Copy the text between start and stop"
+        if start >= stop:
+            return self.text[0:0]
+        pieces = []
+        line = self.locate(start)[0]
+        while (line < len(self.spans)) and (self.offsets[line] < stop):
+            line_start, line_end = self.spans[line]
+            offset = self.offsets[line]
+            end = offset + line_end - line_start
+            pieces.append(self.text[
+                max(start, offset) - offset + line_start:
+                min(stop, end) - offset + line_start])
+            if start <= end < stop:
+                pieces.append(self.join(line))
+            line = line + 1
+        return "".join(pieces)
+
+    def startswith(self, prefix, pos=0):
+        if isinstance(prefix, tuple):
+            return any(self.startswith(p, pos) for p in prefix)
+        if not (0 <= pos <= self.length):
+            return False
+        line, offset = self.locate(pos)
+        end = self.spans[line][1]
+        if offset + len(prefix) <= end:
+            return self.text.startswith(prefix, offset, end)
+        return self.slice(pos, pos + len(prefix)) == prefix
+
+    def find(self, sub, start=0):
+        if not (0 <= start <= self.length):
+            return -1
+        elif not sub:
+            return start
+        line, offset = self.locate(start)
+        if (sub == "\n") and (self.joins is None):
+            if line + 1 < len(self.spans):
+                return self.offsets[line + 1] - 1
+            return -1
+        while True:
+            line_start, line_end = self.spans[line]
+            found = self.text.find(sub, offset, line_end)
+            if found != -1:
+                return self.offsets[line] + found - line_start
+            elif line + 1 == len(self.spans):
+                return -1
+            # Look for sub across the end of the line
+            end = self.offsets[line] + line_end - line_start
+            window_start = max(start, end - len(sub) + 1)
+            found = self.slice(window_start, end + len(self.join(line)) + len(sub) - 1).find(sub)
+            if found != -1:
+                return window_start + found
+            line = line + 1
+            offset = self.spans[line][0]
+
+    def match(self, regex, pos, line_safe=False):
+        """Match regex at pos
+
+        If line_safe is set, regex is a run of characters, so it is
+        matched in place if it stops before the end of the line, and
+        carried on into the next span if they are joined by "".
+        Otherwise the rest of the view has to be copied to match it."""
+        if not (0 <= pos <= self.length):
+            return None
+        if line_safe:
+            line, offset = self.locate(pos)
+            matched = []
+            while True:
+                line_start, end = self.spans[line]
+                join = self.join(line)
+                # The newline is the same in the original text
+                end = end + len(join)
+                found = regex.match(self.text, offset, end)
+                if found is None:
+                    if not matched:
+                        return None
+                    break
+                matched.append(found.group())
+                end_offset = self.offsets[line] + found.end() - line_start
+                if (found.end() < end) or (line + 1 == len(self.spans)):
+                    break
+                elif join:
+                    matched = None
+                    break
+                line = line + 1
+                offset = self.spans[line][0]
+            if matched is not None:
+                return _ViewMatch("".join(matched), end_offset)
+        found = regex.match(self.slice(pos, self.length))
+        return found and _ViewMatch(found.group(), pos + found.end())
+
+class _ViewMatch(object):
+    "A regex match in an IndentedText, with offsets in the view"
+    __slots__ = ("matched", "end_offset")
+
+    def __init__(self, matched, end_offset):
+        self.matched = matched
+        self.end_offset = end_offset
+
+    def group(self):
+        return self.matched
+
+    def end(self):
+        return self.end_offset
+
+def match_regex(regex, text, pos, line_safe=False):
+    "Match regex at pos in text, which may be an IndentedText"
+    if type(text) is IndentedText:
+        return text.match(regex, pos, line_safe)
+    return regex.match(text, pos)
 
 def _get_indented_lines(lines, indent):
     indented_lines = []
@@ -379,8 +920,12 @@ def _get_indented_lines(lines, indent):
     return indented_lines
 
 def do_escape(tree):
-    """Recursively html escape a parse tree"""
-    if isinstance(tree, (list, tuple)):
+    """Recursively html escape a parse tree
+
+    Deferred matches are escaped when they are made."""
+    if isinstance(tree, DeferredMatch):
+        return tree.then(do_escape)
+    elif isinstance(tree, (list, tuple)):
         name = tree[0]
         result = [name]
         for item in tree[1:]:
@@ -392,39 +937,192 @@ def do_escape(tree):
 
 class Escaped(PatternCreator):
     """Match the pattern and html escape the result"""
-    def match(self, text, name):
-        try:
-            match, rest = self.pattern(text)
-        except NoPatternFound:
-            raise NoPatternFound
+    def match_at(self, text, pos, name=""):
+        sub_result = self.pattern.match_at(text, pos)
+        if sub_result is None:
+            return None
+        match, text, pos = sub_result
         result = [name]
         escaped_match = do_escape(match)
         _add_match_to_result(result, escaped_match)
-        return (result, rest)
+        return (result, text, pos)
 
 
 class Lookahead(PatternCreator):
-    """Match the pattern somewhere ahead and remove it from there"""
-    def match(self, text, name):
-        unmatched = ""
-        while text:
-            try:
-                match, rest = self.pattern(text)
-                result = [name]
-                _add_match_to_result(result, match)
-                return (result, unmatched+rest)
-            except NoPatternFound:
-                unmatched = unmatched + text[0]
-                text = text[1:]
-        raise NoPatternFound
+    """Match the pattern somewhere ahead and remove it from there
+
+    The text after it is a view of the text that leaves out the match,
+    rather than a copy."""
+    prefix = None
+
+    def match_at(self, text, pos, name=""):
+        if self.prefix is None:
+            self.prefix = _required_prefix(self.pattern)
+        start = pos
+        while start < len(text):
+            if self.prefix:
+                # Skip to where the pattern could start
+                start = text.find(self.prefix, start)
+                if start == -1:
+                    return None
+            sub_result = self.pattern.match_at(text, start)
+            if sub_result is None:
+                start = start + 1
+                continue
+            match, rest, end = sub_result
+            result = [name]
+            _add_match_to_result(result, match)
+            if rest is not text:
+                # The pattern rewrote the text itself
+                return (result, text[pos:start] + rest[end:], 0)
+            if type(text) is not IndentedText:
+                text = IndentedText(text, [(0, len(text))], [])
+            return (result, text.select([(pos, start), (end, len(text))], ""), 0)
+        return None
+
+class Deferred(PatternCreator):
+    """Find where the pattern would match, but only match it when the
+    match is used
+
+    span is a cheaper pattern that matches the same text as pattern,
+    and by default it is the rest of the line.  The match is a
+    DeferredMatch, which matches pattern against the text that span
+    matched the first time it is used."""
+    def __init__(self, pattern, span=None):
+        self.pattern = _as_pattern(pattern)
+        self.span = _as_pattern(span)
+
+    def __repr__(self):
+        return "<%s pattern=%r span=%r>" % (self.__class__.__name__, self.pattern, self.span)
+
+    def match_at(self, text, pos, name=""):
+        if self.span is None:
+            end = text.find("\n", pos)
+            if end == -1:
+                end = len(text)
+            if end == pos:
+                return None
+        else:
+            result = self.span.match_at(text, pos)
+            if result is None:
+                return None
+            match, text, end = result
+        return (["", DeferredMatch(self.pattern, text[pos:end], name)], text, end)
+
+class DeferredMatch(object):
+    """The match of a Deferred pattern, which is made the first time
+    `match` is used
+
+    transform, if given, is applied to the match when it is made."""
+    def __init__(self, pattern, text, name="", transform=None):
+        self.pattern = pattern
+        self.text = text
+        self.name = name
+        self.transform = transform
+        self._match = None
+
+    def __repr__(self):
+        return "<%s text=%r>" % (self.__class__.__name__, self.text)
+
+    def __eq__(self, other):
+        if isinstance(other, DeferredMatch):
+            other = other.match
+        return self.match == other
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    @property
+    def match(self):
+        """Match the pattern, or raise NoPatternFound if it doesn't
+        match all of the text"""
+        if self._match is None:
+            result = self.pattern.match_at(self.text, 0, self.name)
+            if (result is None) or (result[2] != len(result[1])):
+                raise NoPatternFound
+            self._match = result[0]
+            if self.transform is not None:
+                self._match = self.transform(self._match)
+        return self._match
+
+    def then(self, transform):
+        "A DeferredMatch whose match is transform applied to this one's"
+        if self._match is not None:
+            return transform(self._match)
+        elif self.transform is not None:
+            first, second = self.transform, transform
+            transform = lambda match: second(first(match))
+        return DeferredMatch(self.pattern, self.text, self.name, transform)
+
+def expand(match):
+    """Replace the deferred matches in match with what they match, to
+    give the match that the grammar would have without Deferred"""
+    if isinstance(match, DeferredMatch):
+        return expand(match.match)
+    elif not isinstance(match, list):
+        return match
+    result = [match[0]]
+    for item in match[1:]:
+        if isinstance(item, DeferredMatch):
+            _add_match_to_result(result, expand(item.match))
+        else:
+            result.append(expand(item))
+    return result
+
+def _required_prefix(pattern, seen=None):
+    """Find the text that every match of pattern starts with, or "" if
+    it isn't known"""
+    seen = seen or set()
+    if (pattern is None) or (id(pattern) in seen):
+        return ""
+    seen.add(id(pattern))
+    if type(pattern) is Text:
+        return pattern.pattern
+    elif type(pattern) is Lazy:
+        return _required_prefix(pattern.resolve(), seen)
+    elif type(pattern) in (NamedPattern, Ignore, Join, Escaped):
+        return _required_prefix(pattern.pattern, seen)
+    elif (type(pattern) is Deferred) and pattern.span:
+        return _required_prefix(pattern.span, seen)
+    elif (type(pattern) is CountOf) and (pattern.count > 0):
+        return _required_prefix(pattern.pattern, seen)
+    elif (type(pattern) is AllOf) and pattern.options:
+        return _required_prefix(pattern.options[0], seen)
+    else:
+        return ""
+
+# Whether matches with each name are merged into their parent, worked
+# out the first time each name is seen
+_transparent_names = {}
+
+def _is_transparent(name):
+    "Whether a match with this name is merged into its parent"
+    try:
+        return _transparent_names[name]
+    except KeyError:
+        transparent = (not name) or (name == "<lambda>") or name.startswith("_")
+        _transparent_names[name] = transparent
+        return transparent
 
 def _add_match_to_result(result, match):
     "If the match has no name, extend the result"
-    if (not match[0]) or (match[0] == "<lambda>") or match[0].startswith("_"):
+    if _is_transparent(match[0]):
         result.extend(match[1:])
     else:
         result.append(match)
 
+def _has_text(match):
+    """Whether there is any text in match, as utils.deep_bool, but
+    without walking the match when its name or first item shows that
+    there is"""
+    if not match:
+        return False
+    elif match[0]:
+        return True
+    elif (len(match) > 1) and isinstance(match[1], basestring) and match[1]:
+        return True
+    return utils.deep_bool(match)
+
 matchers = {
     str: lambda text, pattern, pattern_name: Text(pattern)(text, pattern_name),
     unicode: lambda text, pattern, pattern_name: Text(pattern)(text, pattern_name),
@@ -457,6 +1155,460 @@ def do_parse(text, pattern):
         except KeyError:
             raise UnknownMatcherType(pattern_type)
 
-def parse_string(text, pattern):
-    match, rest = pattern(text)
+def wrap_grammar(pattern, wrapper):
+    """Copy the grammar that starts at pattern, with the match_at of
+    every pattern in the copy wrapped
+
+    wrapper is called with each match_at function and returns its
+    replacement, which is called with the pattern as its first
+    argument.  Only the copy is changed, so other parses with the
+    grammar aren't affected.  Each pattern in the copy has the pattern
+    it was copied from as its `original`."""
+    pattern = _as_pattern(pattern)
+    grammar = analysis.Analysis(pattern)
+    if any((getattr(p, "dispatch", False) is None) or (getattr(p, "left_recursive", False) is None)
+           for p in grammar.patterns):
+        grammar.mark()
+    copies = {}
+    for original in grammar.patterns:
+        copied = copies[id(original)] = copy.copy(original)
+        copied.original = getattr(original, "original", original)
+        match_at = getattr(original, "_match_at", None) or type(original).match_at.im_func
+        copied._match_at = wrapper(match_at)
+        copied.match_at = types.MethodType(copied._match_at, copied)
+
+    def copy_of(value):
+        return copies.get(id(value), value)
+
+    def copy_all(values):
+        return tuple(copy_of(value) for value in values)
+
+    for copied in copies.values():
+        for attribute in ("pattern", "span", "initial_indent", "indent_pattern"):
+            if isinstance(copied.__dict__.get(attribute), BasePatternCreator):
+                setattr(copied, attribute, copy_of(getattr(copied, attribute)))
+        if "options" in copied.__dict__:
+            copied.options = copy_all(copied.options)
+        if getattr(copied, "dispatch", None):
+            table, default = copied.dispatch
+            copied.dispatch = (
+                dict((char, copy_all(options)) for char, options in table.items()),
+                copy_all(default))
+        if type(copied) is Lazy:
+            copied.seeds = {}
+    return copies[id(pattern)]
+
+
+class Memo(object):
+    """A packrat cache of the results of matching patterns at each
+    position of text, and of the IndentedText views of it
+
+    Only the most recent `window` positions are kept, so the memory
+    used doesn't grow with the size of the text."""
+    window = 1024
+
+    def __init__(self, text, window=None):
+        self.text = text
+        if window:
+            self.window = window
+        self.positions = {}
+        self.order = collections.deque()
+        self.views = {}
+
+    def results_at(self, pos):
+        "Get the cached results at pos, evicting the oldest position"
+        try:
+            return self.positions[pos]
+        except KeyError:
+            results = self.positions[pos] = {}
+            self.order.append(pos)
+            if len(self.order) > self.window:
+                del self.positions[self.order.popleft()]
+            return results
+
+    def view_key(self, view):
+        """A number for an IndentedText of self.text, which is the same
+        for every view of the same parts of the text"""
+        key = getattr(view, "memo_key", None)
+        if (key is None) or (key[0] is not self):
+            spans = (tuple(view.spans), tuple(view.join(line) for line in range(len(view.spans))))
+            key = view.memo_key = (self, self.views.setdefault(spans, len(self.views)))
+        return key[1]
+
+    def wrap(self, match_at):
+        "Wrap a match_at so that it uses the cache"
+        @functools.wraps(match_at)
+        def memoized(pattern, text, pos, name=""):
+            if text is self.text:
+                position = pos
+            elif (type(text) is IndentedText) and (text.text is self.text):
+                position = (self.view_key(text), pos)
+            else:
+                return match_at(pattern, text, pos, name)
+            if _growing_seeds and ((id(text), pos) in _growing_seeds):
+                # The results here depend on the left recursive seed
+                return match_at(pattern, text, pos, name)
+            results = self.results_at(position)
+            key = (pattern, name)
+            try:
+                result = results[key]
+            except KeyError:
+                result = match_at(pattern, text, pos, name)
+                if not (_growing_seeds and ((id(text), pos) in _growing_seeds)):
+                    results[key] = result
+                return result
+            if (result is not None) and (type(position) is tuple) and (result[1] is not text) and (
+                    getattr(result[1], "memo_key", None) == text.memo_key):
+                # It was matched against another view of the same lines
+                result = (result[0], text, result[2])
+            return result
+        return memoized
+
+def _parse(text, pattern, memoize=False, locator=None):
+    """Match pattern at the start of text, and return (match, text, end)
+
+    If a locator is given, the match is located by it (see
+    tree.Locator)."""
+    pattern = _prepare(text, pattern, memoize, locator)
+    result = pattern.match_at(text, 0)
+    if result is None:
+        raise NoPatternFound
+    return result
+
+def _prepare(text, pattern, memoize=False, locator=None):
+    "Wrap pattern as _parse does"
+    pattern = _as_pattern(pattern)
+    if memoize:
+        if memoize is True:
+            memoize = None
+        pattern = wrap_grammar(pattern, Memo(text, memoize).wrap)
+    if locator is not None:
+        pattern = wrap_grammar(pattern, locator.wrap)
+    return pattern
+
+def _split_many(pattern):
+    """If pattern is a Many, or a NamedPattern of one, return its name
+    and the Many, otherwise return None"""
+    if (type(pattern) is NamedPattern) and (type(pattern.pattern) is Many):
+        return (pattern.name, pattern.pattern)
+    elif type(pattern) is Many:
+        return ("", pattern)
+    return None
+
+def _match_blocks(many, text):
+    """Match the options of many in turn, as many does, and yield
+    (pos, match, text, end) for each of them"""
+    if many.dispatch is None:
+        analysis.Analysis(many).mark()
+    table, default = many.dispatch or ({}, many.options)
+    pos = 0
+    while pos < len(text):
+        for option in table.get(text[pos], default):
+            result = option.match_at(text, pos)
+            if result is not None:
+                break
+        else:
+            return
+        match, rest, end = result
+        yield (pos, match, rest, end)
+        text, pos = rest, end
+
+def _parse_tree(text, pattern, memoize=False, encoding=None):
+    """Parse text with pattern into a tree.Tree
+
+    If pattern is a Many, or a NamedPattern of a Many, each of its
+    options' matches is added to the tree as soon as it is made, so
+    only one of them is kept as a list at a time."""
+    locator = tree.Locator(text)
+    pattern = _prepare(text, pattern, memoize, locator)
+    parsed = tree.Tree(text, encoding)
+    builder = tree.TreeBuilder(parsed, locator, search=False)
+    split = _split_many(pattern)
+    if split is None:
+        builder.add(_parse(text, pattern)[0])
+        return parsed
+    name, many = split
+    root = builder.open(name)
+    source = text
+    pos = 0
+    matched = False
+    for pos, match, text, end in _match_blocks(many, text):
+        matched = True
+        if _has_text(match):
+            if _is_transparent(match[0]):
+                for item in match[1:]:
+                    builder.add(item, root)
+            else:
+                builder.add(match, root)
+        pos = end
+        locator.forget(builder.cursor)
+    if not matched:
+        raise NoPatternFound
+    if len(parsed) == 1:
+        builder.add("", root)
+    end = locator.offset(text, pos)
+    builder.close(root, pos if end is None else end)
+    return parsed
+
+def parse_string(text, pattern, memoize=False, compact=False):
+    """Parse text with pattern and return the match, or raise
+    NoPatternFound if it doesn't match
+
+    If memoize is true, the result of matching each pattern at each
+    position is cached for the length of the parse.  It can be the
+    number of positions to keep in the cache.
+
+    If compact is true, the match is returned as a tree.Tree."""
+    if compact:
+        return _parse_tree(text, pattern, memoize)
+    return _parse(text, pattern, memoize)[0]
+
+def iter_events(text, pattern):
+    """Parse text with pattern, and yield the events of the match
+    (see tree.Tree.events) without building the whole match
+
+    If pattern is a Many, or a NamedPattern of a Many, each of its
+    options' matches is committed as soon as it is made, and its
+    events given before the next is matched, so only one of them is
+    kept at a time.  Otherwise the whole match is made first.  The
+    positions in the events are offsets into text.
+
+    The events are walked straight from the match, but getting exact
+    positions means locating every match (see tree.Locator), so this
+    takes two to three times as long as parse_string, in return for
+    memory that doesn't grow with the text."""
+    locator = tree.Locator(text)
+    pattern = _prepare(text, pattern, locator=locator)
+    split = _split_many(pattern)
+    if split is None:
+        for event in locator.events(_parse(text, pattern)[0]):
+            yield event
+        return
+    name, many = split
+    named = not _is_transparent(name)
+    pos = 0
+    matched = False
+    found_text = False
+    for pos, match, text, end in _match_blocks(many, text):
+        start = locator.offset(text, pos)
+        if start is None:
+            # The text was rewritten, eg by a Lookahead in an Indented
+            start = pos
+        if named and not matched:
+            yield ("start", name, start)
+        matched = True
+        if _has_text(match):
+            found_text = True
+            for event in locator.events(match, start):
+                yield event
+        pos = end
+        locator.forget(start)
+    if not matched:
+        raise NoPatternFound
+    if not found_text:
+        yield ("text", "")
+    if named:
+        end = locator.offset(text, pos)
+        yield ("end", name, pos if end is None else end)
+
+class MappedFile(mmap.mmap):
+    """A memory mapped file, with the str methods that patterns use
+
+    Slicing it gives a str, so only the parts of the file that end up
+    in a match are copied out of it."""
+    def startswith(self, prefix, start=0, end=None):
+        if isinstance(prefix, tuple):
+            return any(self.startswith(p, start, end) for p in prefix)
+        if end is None:
+            end = len(self)
+        stop = start + len(prefix)
+        return (0 <= start) and (stop <= end) and (self[start:stop] == prefix)
+
+def parse_file(path, pattern, memoize=False, encoding=None, compact=False):
+    """Parse the file at path with parse_string, matching against a
+    memory map of it rather than reading it in
+
+    If encoding is given, the strings in the match are decoded with
+    it.  If compact is true, the match is returned as a tree.Tree,
+    which keeps the file mapped to get its text from."""
+    with open(path, "rb") as f:
+        try:
+            text = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            text = ""
+        # A tree keeps the map, anything else is finished with it
+        keep = False
+        try:
+            if compact:
+                parsed = _parse_tree(text, pattern, memoize, encoding)
+                keep = True
+                return parsed
+            match = _parse(text, pattern, memoize)[0]
+        finally:
+            if text and not keep:
+                text.close()
+    if encoding:
+        match = _decode_match(match, encoding)
     return match
+
+def _decode_match(match, encoding):
+    "Decode all the strings in match"
+    if isinstance(match, str):
+        return match.decode(encoding)
+    elif isinstance(match, list):
+        return [_decode_match(item, encoding) for item in match]
+    return match
+
+def parse_chunks(chunks, pattern, lookahead=1024):
+    """Parse a text that arrives as an iterable of chunks, and yield
+    the match for each time pattern matches in turn
+
+    If pattern is a Many, or a NamedPattern of a Many, its options are
+    matched in turn instead, so Many(record) yields one match per
+    record, and the name is left out.  A match is only trusted once
+    there are lookahead characters after it, or the input has ended,
+    so pattern shouldn't need to look further than that past the end
+    of its match.  Only the input from the start of the current match
+    is kept."""
+    pattern = _as_pattern(pattern)
+    if (type(pattern) is NamedPattern) and (type(pattern.pattern) is Many):
+        pattern = pattern.pattern
+    if type(pattern) is Many:
+        options = pattern.options
+    else:
+        options = [pattern]
+    chunks = iter(chunks)
+    text = ""
+    pos = 0
+    finished = False
+    while True:
+        for option in options:
+            result = option.match_at(text, pos)
+            if result is not None:
+                break
+        if result is not None:
+            match, rest, end = result
+            if (rest is not text) or (end > pos):
+                if finished or (end + lookahead <= len(rest)):
+                    text, pos = rest, end
+                    if utils.deep_bool(match):
+                        yield match
+                    continue
+        if finished:
+            if pos < len(text):
+                raise NoPatternFound(text[pos:])
+            return
+        # Drop the input that has been matched, and read some more
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+        else:
+            text = text[pos:] + chunk
+            pos = 0
+
+def parse_stream(fileobj, pattern, chunk_size=65536, lookahead=1024):
+    """Parse the contents of a file-like object with parse_chunks,
+    reading chunk_size characters at a time"""
+    chunks = iter(functools.partial(fileobj.read, chunk_size), "")
+    return parse_chunks(chunks, pattern, lookahead)
+
+# The pattern that parse_many's worker processes parse with
+_worker_pattern = None
+
+def _start_worker(pattern, memoize):
+    "Set up a parse_many worker process"
+    global _worker_pattern
+    if not isinstance(pattern, BasePatternCreator):
+        pattern = pattern()
+    _worker_pattern = (pattern, memoize)
+
+def _parse_in_worker(item):
+    """Parse a text in a worker, and return its index, its match, and
+    whether all of it was matched"""
+    index, text = item
+    pattern, memoize = _worker_pattern
+    match, rest, end = _parse(text, pattern, memoize)
+    return (index, match, (rest is text) and (end == len(text)))
+
+def _parse_in_pool(texts, pattern, workers, chunksize, ordered, memoize):
+    "Yield the results of _parse_in_worker for each of texts"
+    pool = multiprocessing.Pool(workers, _start_worker, (pattern, memoize))
+    try:
+        if ordered:
+            results = pool.imap(_parse_in_worker, enumerate(texts), chunksize)
+        else:
+            results = pool.imap_unordered(_parse_in_worker, enumerate(texts), chunksize)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def parse_many(texts, pattern, workers=None, chunksize=16, ordered=True, memoize=False):
+    """Parse each of texts with parse_string in a pool of worker
+    processes, and yield their matches
+
+    pattern is sent to each worker once, when it starts.  It can be a
+    module level function that returns the pattern, for grammars that
+    can't be pickled.  The texts are sent to the workers chunksize at
+    a time.  If ordered is false, (index, match) pairs are yielded as
+    soon as each text is parsed."""
+    results = _parse_in_pool(texts, pattern, workers, chunksize, ordered, memoize)
+    for index, match, complete in results:
+        if ordered:
+            yield match
+        else:
+            yield (index, match)
+
+# Blank lines that aren't followed by an indented line
+BLANK_LINES = re.compile(r"\n(?:[ \t]*\n)+(?=[^ \t\n])")
+
+def split_blocks(text, boundary=BLANK_LINES, chunk_size=65536):
+    """Split text after each match of the regular expression boundary,
+    and join the pieces back into chunks of at least chunk_size"""
+    if isinstance(boundary, basestring):
+        boundary = re.compile(boundary)
+    chunks = []
+    start = 0
+    for found in boundary.finditer(text):
+        if found.end() - start >= chunk_size:
+            chunks.append(text[start:found.end()])
+            start = found.end()
+    if (start < len(text)) or not chunks:
+        chunks.append(text[start:])
+    return chunks
+
+def parse_blocks(text, pattern, workers=None, boundary=BLANK_LINES,
+                 chunk_size=65536, memoize=False):
+    """Parse text, which is made of independent blocks, with a Many
+    pattern, by parsing chunks of blocks in parallel with parse_many
+
+    The text is split with split_blocks, so boundary has to only match
+    where the Many moves from one block to the next.  The matches of
+    the chunks are joined into the match that parse_string would give.
+    If a chunk doesn't match all the way to its end, the whole text is
+    parsed with parse_string instead.  As with parse_many, pattern can be a
+    function that returns the pattern."""
+    chunks = split_blocks(text, boundary, chunk_size)
+    if len(chunks) > 1:
+        try:
+            results = list(_parse_in_pool(chunks, pattern, workers, 1, True, memoize))
+        except NoPatternFound:
+            results = None
+        # Each chunk but the last has to be matched all the way through
+        if results and all(complete for index, match, complete in results[:-1]):
+            return _join_matches([match for index, match, complete in results])
+    if not isinstance(pattern, BasePatternCreator):
+        pattern = pattern()
+    return parse_string(text, pattern, memoize)
+
+def _join_matches(matches):
+    "Join the matches of a Many on consecutive parts of a text"
+    result = [matches[0][0]]
+    for match in matches:
+        if utils.deep_bool(match[1:]):
+            result.extend(match[1:])
+    if len(result) == 1:
+        result.append("")
+    return result
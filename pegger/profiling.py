@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Profiling parses
+
+A `Profile` records, for every pattern of the grammar that it
+instruments, how many times it was tried, how many of those it matched,
+how long it took with and without the patterns that it used, and how
+much text its matches consumed.  `Backtracking` records where in a text
+the parser went over the same ground more than once.  Instrumenting a
+grammar copies it, so parses with the grammar itself aren't recorded.
+A compiled grammar is profiled as a single pattern, as its parts don't
+go through `match_at`."""
+
+import bisect
+import collections
+import functools
+import timeit
+
+import pegger
+
+# The columns that a report can be sorted by
+COLUMNS = ("calls", "matches", "failures", "total", "own", "consumed")
+
+
+class Stats(object):
+    """What a Profile found out about one pattern"""
+    def __init__(self, pattern, label):
+        self.pattern = pattern
+        self.label = label
+        self.calls = 0
+        self.matches = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.consumed = 0
+
+    def __repr__(self):
+        return "<%s %s calls=%s>" % (self.__class__.__name__, self.label, self.calls)
+
+    @property
+    def failures(self):
+        return self.calls - self.matches
+
+    def as_dict(self):
+        "The stats as a dict of plain values"
+        found = dict((column, getattr(self, column)) for column in COLUMNS)
+        found["pattern"] = self.label
+        return found
+
+
+def describe(pattern, name, rule):
+    """A label for pattern, called with name, inside the named rule"""
+    kind = type(pattern).__name__
+    if type(pattern) in (pegger.NamedPattern, pegger.Lazy):
+        return "%s %r" % (kind, pattern.name)
+    elif type(pattern) in (pegger.Text, pegger.Some):
+        return "%s %r" % (kind, pattern.pattern)
+    elif name or rule:
+        return "%s in %r" % (kind, name or rule)
+    return kind
+
+
+class Profile(object):
+    """The Stats of each pattern matched by the grammars it instruments"""
+    def __init__(self, timer=timeit.default_timer):
+        self.timer = timer
+        self.stats = {}
+        self.match = None
+        # The time spent in sub-patterns, and the name of the rule, of
+        # each pattern that is being matched
+        self.stack = []
+
+    def wrap(self, match_at):
+        "Wrap a match_at so that it records its stats"
+        timer = self.timer
+        stack = self.stack
+
+        @functools.wraps(match_at)
+        def profiled(pattern, text, pos, name=""):
+            rule = name or (stack[-1][1] if stack else "")
+            frame = [0.0, rule]
+            stack.append(frame)
+            start = timer()
+            try:
+                result = match_at(pattern, text, pos, name)
+            finally:
+                elapsed = timer() - start
+                stack.pop()
+                if stack:
+                    stack[-1][0] += elapsed
+            stats = self.stats.get(id(pattern.original))
+            if stats is None:
+                stats = self.stats[id(pattern.original)] = Stats(
+                    pattern.original, describe(pattern, name, rule))
+            stats.calls += 1
+            stats.total += elapsed
+            stats.own += elapsed - frame[0]
+            if result is not None:
+                stats.matches += 1
+                if result[1] is text:
+                    stats.consumed += result[2] - pos
+            return result
+        return profiled
+
+    def instrument(self, pattern):
+        "A copy of the grammar that records its stats in the profile"
+        return pegger.wrap_grammar(pattern, self.wrap)
+
+    def sorted(self, sort="own"):
+        "The Stats, with the largest value of the column sort first"
+        if sort not in COLUMNS:
+            raise ValueError("Can't sort by %r, only by one of %s" % (sort, ", ".join(COLUMNS)))
+        return sorted(self.stats.values(), key=lambda stats: getattr(stats, sort), reverse=True)
+
+    def dump(self, sort="own"):
+        "The stats as a list of dicts, eg to be written out as JSON"
+        return [stats.as_dict() for stats in self.sorted(sort)]
+
+    def report(self, sort="own", limit=None):
+        "The stats as a table of text"
+        lines = ["%8s %8s %8s %10s %10s %10s  %s" % (COLUMNS + ("pattern",))]
+        for stats in self.sorted(sort)[:limit]:
+            lines.append("%8d %8d %8d %10.6f %10.6f %10d  %s" % (
+                stats.calls, stats.matches, stats.failures,
+                stats.total, stats.own, stats.consumed, stats.label))
+        return "\n".join(lines)
+
+
+def profile(text, pattern, timer=timeit.default_timer):
+    """Parse text with pattern, and return the Profile of the parse,
+    with the match as its `match`, eg
+
+        print profile(text, grammar).report()
+    """
+    found = Profile(timer)
+    found.match = pegger.parse_string(text, found.instrument(pattern))
+    return found
+
+
+class Waste(object):
+    """The failures of one option of a OneOf or Many, after it had
+    looked at some of the text"""
+    def __init__(self, pattern, label):
+        self.pattern = pattern
+        self.label = label
+        self.failures = 0
+        self.wasted = 0
+        self.longest = 0
+
+    def __repr__(self):
+        return "<%s %s wasted=%s>" % (self.__class__.__name__, self.label, self.wasted)
+
+
+class Backtracking(object):
+    """How many times patterns were tried at each offset of text, and
+    how much of the text the options that failed had got through
+
+    Patterns matched against an Indented view of the text are counted
+    at their offsets in the text."""
+    def __init__(self, text):
+        self.text = text
+        self.attempts = collections.defaultdict(int)
+        self.wasted = collections.defaultdict(int)
+        self.options = {}
+        # How far into the text each pattern being matched has got,
+        # and the pattern
+        self.stack = []
+        self.match = None
+
+    def offset(self, text, pos):
+        "The offset in self.text of pos in text, or None"
+        if text is self.text:
+            return pos
+        elif (type(text) is pegger.IndentedText) and (text.text is self.text):
+            return text.original_offset(pos)
+        return None
+
+    def wrap(self, match_at):
+        "Wrap a match_at so that it records where it was tried"
+        stack = self.stack
+
+        @functools.wraps(match_at)
+        def tracked(pattern, text, pos, name=""):
+            start = self.offset(text, pos)
+            if start is None:
+                return match_at(pattern, text, pos, name)
+            self.attempts[start] += 1
+            stack.append([start, pattern])
+            try:
+                result = match_at(pattern, text, pos, name)
+            finally:
+                furthest = stack.pop()[0]
+            if result is not None:
+                end = self.offset(result[1], result[2])
+                if end is not None:
+                    furthest = max(furthest, end)
+            elif (furthest > start) and stack and (
+                    type(stack[-1][1]) in (pegger.OneOf, pegger.Many)):
+                self.record_waste(pattern, name, start, furthest)
+            if stack and (furthest > stack[-1][0]):
+                stack[-1][0] = furthest
+            return result
+        return tracked
+
+    def record_waste(self, pattern, name, start, furthest):
+        "Record that pattern failed at start after getting to furthest"
+        waste = self.options.get(id(pattern.original))
+        if waste is None:
+            waste = self.options[id(pattern.original)] = Waste(
+                pattern.original, describe(pattern, name, ""))
+        waste.failures += 1
+        waste.wasted += furthest - start
+        waste.longest = max(waste.longest, furthest - start)
+        self.wasted[start] += furthest - start
+
+    def instrument(self, pattern):
+        "A copy of the grammar that records where it was tried"
+        return pegger.wrap_grammar(pattern, self.wrap)
+
+    def repeated(self):
+        """The number of times patterns were tried at each offset after
+        the first, for the offsets where they were"""
+        return dict((pos, count - 1) for pos, count in self.attempts.items() if count > 1)
+
+    def wasteful_options(self, limit=None):
+        "The options that wasted the most text, most first"
+        found = sorted(self.options.values(), key=lambda waste: waste.wasted, reverse=True)
+        return found[:limit]
+
+    def heatmap(self):
+        """The attempts, and the text wasted by options that failed,
+        starting on each line of the text, as a list of
+        `(attempts, wasted)` with one entry per line"""
+        starts = [0]
+        pos = self.text.find("\n")
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = self.text.find("\n", pos + 1)
+        lines = [[0, 0] for start in starts]
+        for pos, count in self.attempts.items():
+            lines[bisect.bisect_right(starts, pos) - 1][0] += count
+        for pos, wasted in self.wasted.items():
+            lines[bisect.bisect_right(starts, pos) - 1][1] += wasted
+        return [tuple(line) for line in lines]
+
+    def report(self, limit=10):
+        "The lines with the most attempts, as a table of text"
+        text_lines = self.text.split("\n")
+        lines = ["%6s %8s %8s  %s" % ("line", "attempts", "wasted", "text")]
+        heatmap = sorted(enumerate(self.heatmap()), key=lambda item: item[1], reverse=True)
+        for number, (attempts, wasted) in heatmap[:limit]:
+            lines.append("%6d %8d %8d  %s" % (
+                number + 1, attempts, wasted, text_lines[number][:40]))
+        return "\n".join(lines)
+
+
+def backtracking(text, pattern):
+    """Parse text with pattern, and return the Backtracking of the
+    parse, with the match as its `match`, eg
+
+        print backtracking(text, grammar).report()
+    """
+    found = Backtracking(text)
+    found.match = pegger.parse_string(text, found.instrument(pattern))
+    return found
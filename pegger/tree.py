@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""A compact form for parse trees
+
+A match is a nested list of names and strings, where each string is a
+copy of part of the text.  A `Tree` keeps the same information as a
+table of nodes in arrays, and only keeps the offsets of the strings
+that come from the text, slicing them out when they are asked for.
+
+A grammar wrapped by a `Locator` gives matches that know where in the
+text they came from, so that the offsets in the tree are exact."""
+
+import functools
+import itertools
+from array import array
+
+import pegger
+
+# The kinds of leaf, named nodes have their name's index as their kind
+SPAN = -1
+LITERAL = -2
+
+
+class Tree(object):
+    """A parse tree stored as a table of nodes
+
+    The nodes are numbered in the order they appear in the match,
+    starting with the root at 0.  Each node has a kind, a start and
+    end offset into the source, and the number of its parent."""
+    def __init__(self, source, encoding=None):
+        self.source = source
+        self.encoding = encoding
+        self.names = []
+        self.name_ids = {}
+        self.literals = []
+        # 'l' rather than 'i', so that offsets into large files fit
+        self.kinds = array('l')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.parents = array('l')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __repr__(self):
+        return "<%s nodes=%s>" % (self.__class__.__name__, len(self))
+
+    def add(self, kind, start, end, parent):
+        "Add a node and return its number"
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.parents.append(parent)
+        return len(self.kinds) - 1
+
+    def name_id(self, name):
+        "Get the kind for nodes called name"
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.name_ids[name]
+
+    def is_leaf(self, node):
+        return self.kinds[node] < 0
+
+    def name(self, node):
+        "The name of node, or None if it is a leaf"
+        kind = self.kinds[node]
+        if kind < 0:
+            return None
+        return self.names[kind]
+
+    def text(self, node):
+        "The text of a leaf, or the text that a node spans"
+        kind = self.kinds[node]
+        if kind <= LITERAL:
+            return self.literals[LITERAL - kind]
+        text = self.source[self.starts[node]:self.ends[node]]
+        if self.encoding:
+            text = text.decode(self.encoding)
+        return text
+
+    def children(self, node):
+        "The numbers of the children of node"
+        children = []
+        parents = self.parents
+        # Nodes after node's descendants have a parent before node
+        for child in xrange(node + 1, len(parents)):
+            parent = parents[child]
+            if parent < node:
+                break
+            elif parent == node:
+                children.append(child)
+        return children
+
+    def to_list(self, node=0):
+        "Convert the tree, from node down, to the nested list form"
+        if not len(self):
+            # The match was empty
+            return []
+        elif self.is_leaf(node):
+            return self.text(node)
+        lists = {node: [self.name(node)]}
+        parents = self.parents
+        for child in xrange(node + 1, len(parents)):
+            parent = parents[child]
+            if parent not in lists:
+                break
+            if self.kinds[child] < 0:
+                lists[parent].append(self.text(child))
+            else:
+                lists[child] = [self.name(child)]
+                lists[parent].append(lists[child])
+        return lists[node]
+
+    def events(self, node=0):
+        """Yield the events for node and the nodes under it, in order
+
+        These are `("start", name, pos)` and `("end", name, pos)` for
+        named nodes, and `("text", text)` for leaves.  Nodes with no
+        name, or a name starting with "_", only give their contents,
+        as they are merged into their parent in a match."""
+        if not len(self):
+            return
+        elif self.is_leaf(node):
+            yield ("text", self.text(node))
+            return
+        parents = self.parents
+        stack = []
+        for child in xrange(node, len(parents)):
+            if child > node:
+                parent = parents[child]
+                if parent < node:
+                    break
+                while stack[-1] != parent:
+                    event = self._end_event(stack.pop())
+                    if event:
+                        yield event
+            if self.kinds[child] < 0:
+                yield ("text", self.text(child))
+            else:
+                name = self.name(child)
+                if not pegger._is_transparent(name):
+                    yield ("start", name, self.starts[child])
+                stack.append(child)
+        while stack:
+            event = self._end_event(stack.pop())
+            if event:
+                yield event
+
+    def _end_event(self, node):
+        name = self.name(node)
+        if not pegger._is_transparent(name):
+            return ("end", name, self.ends[node])
+        return None
+
+
+class Leaf(str):
+    """A copy of a string in a located match, so that it can be told
+    apart from other matches of the same string"""
+    __slots__ = ()
+
+
+class UnicodeLeaf(unicode):
+    "A Leaf of a unicode text"
+    __slots__ = ()
+
+
+class Locator(object):
+    """Wraps the match_at of patterns (see pegger.wrap_grammar) so
+    that their matches of source know where they came from
+
+    Each named list in a match, and each string that a single pattern
+    matched, is recorded in positions with its offsets into source,
+    which may have been matched through an IndentedText view of it.
+    The strings are replaced by Leaves, so that each has its own
+    entry.  The entries are looked up with located."""
+    def __init__(self, source):
+        self.source = source
+        # id(item) -> (item, start, end), which keeps item alive
+        self.positions = {}
+
+    def offset(self, text, pos):
+        "The offset in source of pos in text, or None"
+        if text is self.source:
+            return pos
+        elif (type(text) is pegger.IndentedText) and (text.text is self.source):
+            return text.original_offset(pos)
+        return None
+
+    def located(self, item):
+        "The (start, end) of item in source, or None"
+        entry = self.positions.get(id(item))
+        if (entry is None) or (entry[0] is not item):
+            return None
+        return entry[1:]
+
+    def forget(self, pos):
+        "Drop the positions of the matches that started before pos"
+        positions = self.positions
+        for key in [key for key, entry in positions.iteritems() if entry[1] < pos]:
+            del positions[key]
+
+    def wrap(self, match_at):
+        """Wrap a match_at so that it locates its match
+
+        The patterns that only put together the matches of their own
+        patterns are left alone, as the parts of their matches are
+        located already, and the NamedPattern around them (if there
+        is one) locates the whole."""
+        if match_at in _combinators():
+            return match_at
+        positions = self.positions
+        is_transparent = pegger._is_transparent
+
+        @functools.wraps(match_at)
+        def located(pattern, text, pos, name=""):
+            result = match_at(pattern, text, pos, name)
+            if result is None:
+                return result
+            match, rest, end = result
+            if (type(match) is not list) or (not match) or (rest is not text):
+                return result
+            leaf = (len(match) == 2) and (type(match[1]) in (str, unicode))
+            if not leaf and (is_transparent(match[0]) or (id(match) in positions)):
+                # It will be merged into its parent, or it was located already
+                return result
+            start = self.offset(text, pos)
+            if start is None:
+                return result
+            end = self.offset(text, end)
+            positions[id(match)] = (match, start, end)
+            if leaf:
+                match[1] = self.leaf(match[1], start, end)
+            return result
+        return located
+
+    def events(self, match, start=0):
+        """Yield the events of a located match that starts at start, as
+        compact(match, source, start=start, search=False,
+        locator=self).events() would, without building the Tree"""
+        if not isinstance(match, list):
+            located = self.located(match)
+            yield ("text", match if located is None else self.source[located[0]:located[1]])
+            return
+        is_transparent = pegger._is_transparent
+        cursor = start
+        # The children left to walk, the name to end, and where it ends
+        stack = [(iter((match,)), None, None)]
+        while stack:
+            items, name, end = stack[-1]
+            item = next(items, stack)
+            if item is stack:
+                stack.pop()
+                if end is not None:
+                    cursor = end
+                if name is not None:
+                    yield ("end", name, cursor)
+                continue
+            located = self.located(item)
+            if isinstance(item, list):
+                if not item:
+                    continue
+                name = item[0]
+                if is_transparent(name):
+                    name = None
+                if located is not None:
+                    cursor = located[0]
+                    if name is not None:
+                        yield ("start", name, cursor)
+                    stack.append((itertools.islice(item, 1, None), name, located[1]))
+                else:
+                    if name is not None:
+                        yield ("start", name, self._first_start(item, cursor))
+                    stack.append((itertools.islice(item, 1, None), name, None))
+            elif located is not None:
+                cursor = located[1]
+                yield ("text", self.source[located[0]:cursor])
+            else:
+                yield ("text", item)
+
+    def _first_start(self, match, cursor):
+        "Where compact starts a match that isn't located: where its first child does"
+        while True:
+            located = self.located(match)
+            if located is not None:
+                return located[0]
+            elif not isinstance(match, list) or (len(match) < 2) or (match[1] == []):
+                return cursor
+            match = match[1]
+
+    def leaf(self, string, start, end):
+        "A Leaf for string, which was matched between start and end"
+        if type(string) is unicode:
+            leaf = UnicodeLeaf(string)
+        else:
+            leaf = Leaf(string)
+        if (end - start == len(string)) and (self.source[start:end] == string):
+            self.positions[id(leaf)] = (leaf, start, end)
+        return leaf
+
+
+def _combinators():
+    "The match_at functions that Locator.wrap leaves alone"
+    return frozenset(
+        pattern.match_at.im_func
+        for pattern in (pegger.AllOf, pegger.OneOf, pegger.Many, pegger.Optional, pegger.Ignore))
+
+
+class TreeBuilder(object):
+    """Adds matches to a Tree, see compact
+
+    The matches are added in the order they come in the source, so
+    that a parse can add each part of its match as it is made."""
+    def __init__(self, tree, locator=None, window=4096, start=0, search=True):
+        self.tree = tree
+        self.locator = locator
+        self.window = window
+        self.cursor = start
+        self.search = search
+
+    def locate(self, item):
+        if self.locator is None:
+            return None
+        return self.locator.located(item)
+
+    def add(self, match, parent=-1):
+        "Add match as a child of parent, and return its node, or None if it is empty"
+        if isinstance(match, list):
+            if match:
+                return self.add_node(match, parent)
+            return None
+        return self.add_leaf(match, parent)
+
+    def add_leaf(self, leaf, parent):
+        tree = self.tree
+        located = self.locate(leaf)
+        if located is not None:
+            self.cursor = located[1]
+            return tree.add(SPAN, located[0], located[1], parent)
+        elif self.search and isinstance(leaf, basestring) and not isinstance(leaf, (Leaf, UnicodeLeaf)):
+            pos = self.cursor
+            source = tree.source
+            if tree.encoding and isinstance(leaf, unicode):
+                encoded = leaf.encode(tree.encoding)
+            else:
+                encoded = leaf
+            if source.startswith(encoded, pos):
+                found = pos
+            elif encoded:
+                found = source.find(encoded, pos, pos + self.window + len(encoded))
+            else:
+                found = -1
+            if found != -1:
+                self.cursor = found + len(encoded)
+                return tree.add(SPAN, found, self.cursor, parent)
+        tree.literals.append(leaf)
+        return tree.add(LITERAL - (len(tree.literals) - 1), self.cursor, self.cursor, parent)
+
+    def add_node(self, match, parent):
+        tree = self.tree
+        located = self.locate(match)
+        if located is not None:
+            self.cursor = located[0]
+        node = self.open(match[0], parent)
+        for item in match[1:]:
+            child = self.add(item, node)
+            if (child == node + 1) and (located is None):
+                tree.starts[node] = tree.starts[child]
+        if located is not None:
+            self.cursor = located[1]
+        self.close(node)
+        return node
+
+    def open(self, name, parent=-1):
+        "Add a node called name at the cursor, to be closed once its children are added"
+        return self.tree.add(self.tree.name_id(name), self.cursor, self.cursor, parent)
+
+    def close(self, node, end=None):
+        "End node at end, or at the cursor"
+        if end is not None:
+            self.cursor = end
+        self.tree.ends[node] = self.cursor
+
+
+def compact(match, source, encoding=None, window=4096, start=0, search=True, locator=None):
+    """Build a Tree from match, which was parsed from source starting
+    at start
+
+    The parts of a match located by locator have their offsets in
+    source.  Other strings are looked for in source a little after the
+    previous one, up to window characters on, to allow for text that
+    was ignored, unless search is false.  Strings that aren't found
+    there (eg ones that were inserted or escaped) are kept as they
+    are."""
+    tree = Tree(source, encoding)
+    TreeBuilder(tree, locator, window, start, search).add(match)
+    return tree
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+
+import py
+
+import pegger as pg
+from pegger import analysis
+
+
+def test_nullable():
+    "Test finding which patterns can match nothing"
+    word = pg.Words()
+    maybe = pg.Optional("a")
+    both = pg.AllOf(maybe, pg.Insert("b"))
+    either = pg.OneOf(word, both)
+
+    @pg.lazy
+    def nested():
+        return pg.OneOf(
+            pg.AllOf("(", nested, ")"),
+            pg.AllOf(nested, word))
+
+    grammar = analysis.Analysis(pg.AllOf(either, nested))
+    assert grammar.is_nullable(maybe)
+    assert grammar.is_nullable(both)
+    assert grammar.is_nullable(either)
+    assert not grammar.is_nullable(word)
+    assert not grammar.is_nullable(nested)
+
+def test_left_recursive():
+    "Test finding the lazy patterns that are left recursive"
+    @pg.lazy
+    def expr():
+        return pg.OneOf(
+            pg.AllOf(pg.Optional(" "), expr, "+", term),
+            term)
+
+    @pg.lazy
+    def term():
+        return pg.OneOf(
+            pg.AllOf("(", expr, ")"),
+            pg.Words("0123456789"))
+
+    grammar = analysis.Analysis(expr)
+    assert grammar.left_recursive() == [expr]
+    grammar.mark()
+    assert expr.left_recursive is True
+    assert term.left_recursive is False
+
+def test_first():
+    "Test finding the characters that matches can start with"
+    digits = pg.Words(pg.CharClass("0-9"))
+    signed = pg.AllOf(pg.Optional(pg.OneOf("+", "-")), digits)
+    word = pg.Words("ab")
+
+    grammar = analysis.Analysis(pg.OneOf(signed, word, pg.Not("x")))
+    assert grammar.get_first(digits) == frozenset("0123456789")
+    assert grammar.get_first(signed) == frozenset("+-0123456789")
+    assert grammar.get_first(word) == frozenset("ab")
+    assert grammar.get_first(grammar.root) is analysis.ANY
+    assert analysis.letter_set(pg.CharClass("^a")) is analysis.ANY
+
+def test_dispatch_table():
+    "Test narrowing down the options of a OneOf by the next character"
+    number = pg.Words("0123456789")
+    word = pg.Words("ab")
+    maybe = pg.Optional("a")
+    either = pg.OneOf(number, word, maybe)
+
+    table, default = analysis.Analysis(either).dispatch_table(either)
+    assert default == (maybe,)
+    assert table["1"] == (number, maybe)
+    assert table["a"] == (word, maybe)
+
+    not_either = pg.OneOf(pg.Not("x"), maybe)
+    assert analysis.Analysis(not_either).dispatch_table(not_either) is None
+
+def test_dispatch_matches():
+    "Test that dispatching gives the same matches as trying every option"
+    either = pg.Many(
+        pg.NamedPattern('number', pg.Words("0123456789")),
+        pg.NamedPattern('word', pg.Words("ab")),
+        pg.NamedPattern('other', pg.Not("!")))
+
+    match, rest = either("a1b2?!")
+    assert either.dispatch
+    assert match == [
+        '', ['word', "a"], ['number', "1"], ['word', "b"],
+        ['number', "2"], ['other', "?"]]
+    assert rest == "!"
+
+def test_never_stop():
+    "Test finding Many patterns that would never stop"
+    maybe = pg.Optional("a")
+    forever = pg.Many("b", maybe)
+    grammar = analysis.Analysis(pg.AllOf(forever, pg.Many("c")))
+    assert grammar.never_stop() == [
+        "%r can match nothing, so %r would never stop" % (maybe, forever)]
+
+    with py.test.raises(pg.GrammarError):
+        pg.validate(forever)
+    with py.test.raises(pg.GrammarError):
+        pg.compile(pg.Many(pg.Insert("x")))
+
+def test_unreachable():
+    "Test finding options that can never be reached"
+    short = pg.Text("a")
+    long = pg.NamedPattern('long', pg.Text("ab"))
+    always = pg.Optional("c")
+    never = pg.Text("d")
+    options = pg.OneOf(short, long, always, never)
+
+    grammar = analysis.Analysis(options)
+    assert grammar.unreachable() == [
+        "%r in %r is never reached, because %r matches first" % (long, options, short),
+        "%r in %r is never reached, because %r matches first" % (never, options, always)]
+    assert analysis.Analysis(pg.OneOf("ab", "a", pg.EOF(), "c")).unreachable() == []
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        pg.validate(options)
+    assert [w.category for w in caught] == [pg.GrammarWarning] * 2
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import py
+
+import pegger as pg
+
+
+def assert_compiles(pattern, data, name=""):
+    "Test that the compiled pattern gives the same result as pattern"
+    for regex in [False, True]:
+        compiled = pg.compile(pattern, regex=regex)
+        try:
+            expected = pattern(data, name)
+        except pg.NoPatternFound:
+            with py.test.raises(pg.NoPatternFound):
+                compiled(data, name)
+        else:
+            assert compiled(data, name) == expected
+
+def test_compile_terminals():
+    items = [
+        (pg.Text("a"), ["a", "ab", "b", ""]),
+        (pg.Some("a"), ["aab", "b", ""]),
+        (pg.Words(), ["some words 123", "123"]),
+        (pg.Words(pg.CharClass("^\n")), ["a line\n", "\n"]),
+        (pg.Words(pg.CharClass("^")), ["^^a", "a"]),
+        (pg.Words(pg.CharClass("]\\-")), ["]\\-^", "^"]),
+        (pg.Some("ab"), ["abab"]),
+        (pg.Not("a"), ["ba", "a", ""]),
+        (pg.Insert("a"), ["b"]),
+        (pg.EOF(), ["", "a"]),
+        (pg.Ignore("a"), ["ab", "b"]),
+        (pg.Optional("a"), ["ab", "b"]),
+        ]
+    for pattern, data in items:
+        for item in data:
+            assert_compiles(pattern, item, 'name')
+
+def test_compile_combinators():
+    letter_a = pg.NamedPattern('letter_a', "a")
+    emphasis = pg.NamedPattern(
+        'emphasis',
+        pg.AllOf(
+            pg.Ignore("*"),
+            pg.Words(),
+            pg.Ignore("*")))
+    words = pg.NamedPattern('words', pg.Words())
+
+    items = [
+        (pg.AllOf(letter_a, pg.Words()), ["abc!", "cab"]),
+        (pg.AllOf(pg.Ignore("a"), pg.Ignore("b")), ["ab"]),
+        (pg.OneOf(pg.Ignore("*"), pg.Ignore("-")), ["*", "-", "+"]),
+        (pg.OneOf(pg.Words(), emphasis), ["*bold*", "text", "123"]),
+        (pg.Many(emphasis, words), ["a phrase with *bold words* in it", "1"]),
+        (pg.Many(pg.OneOf(pg.Ignore("\n"))), ["\n\n"]),
+        (pg.Join(pg.Many(pg.Not("d"))), ["abcd", "d"]),
+        (pg.Join(pg.CountOf(3, "a")), ["aaa", "aa"]),
+        (pg.Not(pg.OneOf("a", "b")), ["cca", "abc"]),
+        (pg.Escaped(pg.Many(pg.Words(pg.Words.letters + "</>"))),
+         ["<p>Some text</p>"]),
+        (pg.AllOf(pg.Lookahead("foo"), pg.Words()), ["bar foo baz"]),
+        (pg.AllOf(pg.Optional(letter_a), pg.Insert(" : "), pg.EOF()),
+         ["a", ""]),
+        ]
+    for pattern, data in items:
+        for item in data:
+            assert_compiles(pattern, item, 'name')
+            assert_compiles(pattern, item, '')
+
+def test_compile_nested_list():
+    list_item = pg.NamedPattern(
+        'list_item',
+        pg.AllOf(
+            pg.Ignore(
+                pg.Optional(
+                    pg.Many("\n"))),
+            pg.Ignore("* "),
+            pg.Words()))
+
+    @pg.lazy
+    def nested_list():
+        return pg.AllOf(
+            pg.Ignore(
+                pg.Optional(
+                    pg.Many("\n"))),
+            pg.Indented(
+                pg.AllOf(
+                    list_item,
+                pg.Optional(
+                    pg.Many(
+                        list_item,
+                        nested_list))),
+                optional=True))
+
+    data = """
+* A bullet
+  * A bullet in a sublist
+  * Another bullet in a sublist
+* Another bullet in the first list
+"""
+
+    expected = pg.parse_string(data, nested_list)
+    assert pg.parse_string(data, pg.compile(nested_list)) == expected
+    assert pg.parse_string(data, pg.compile(nested_list, regex=True)) == expected
+
+def test_compile_function():
+    "Test that plain callables are called by the compiled pattern"
+    def letter_a(text):
+        return pg.Text("a")(text, 'letter_a')
+
+    assert_compiles(pg.Many(letter_a, "b"), "abac", 'letters')
+
+def test_compiled_source():
+    "Test that names are inlined into the compiled source"
+    pattern = pg.compile(
+        pg.AllOf(
+            pg.NamedPattern('letter_a', "a"),
+            pg.Text("b")))
+
+    assert "result.append(['letter_a', 'a'])" in pattern.source
+    assert "result.append('b')" in pattern.source
+    assert "_add" not in pattern.source
+
+def test_compile_regex():
+    "Test that regular parts of a grammar are matched with one regex"
+    emphasis = pg.NamedPattern(
+        'emphasis',
+        pg.AllOf(
+            pg.Ignore("*"),
+            pg.Join(pg.Many(pg.Not("*"))),
+            pg.Ignore("*")))
+    line = pg.NamedPattern(
+        'line',
+        pg.AllOf(
+            pg.Many(emphasis, pg.Words()),
+            pg.Ignore(pg.Optional(pg.Many("\n")))))
+
+    pattern = pg.compile(pg.Many(line), regex=True)
+    assert pattern.source.count(".match(text, pos)") == 3
+
+    data = "some *bold* text\n\nmore text\n"
+    assert pattern(data, 'lines') == pg.Many(line)(data, 'lines')
+
+def test_compile_regex_without_backtracking():
+    "Test that regexes don't backtrack where the pattern wouldn't"
+    items = [
+        (pg.Ignore(pg.AllOf(pg.OneOf("a", "ab"), "c")), ["abc", "ac"]),
+        (pg.Ignore(pg.AllOf(pg.Some("a"), "a")), ["aa"]),
+        (pg.Ignore(pg.AllOf(pg.Words(), "a")), ["abc a"]),
+        (pg.Ignore(pg.AllOf(pg.Optional("a"), "a")), ["a", "aa"]),
+        (pg.Ignore(pg.AllOf(pg.Many("a", "ab"), "bc")), ["abc"]),
+        (pg.Join(pg.Many(pg.Not(pg.AllOf("\n", "\n")))), ["a\nb\n\nc"]),
+        (pg.Many(pg.Not("x"), "x"), ["abxc"]),
+        (pg.Many(pg.NamedPattern('_a', pg.Not("x"))), ["abxc"]),
+        ]
+    for pattern, data in items:
+        for item in data:
+            assert_compiles(pattern, item, 'name')
+            assert_compiles(pattern, item, '')
+
+def test_regex_for():
+    regex, nullable = pg.codegen.regex_for(
+        pg.AllOf(pg.Optional("a"), pg.Some("b")))
+    assert regex.pattern == "(?:(?=((?:a)?))\\1)(?:(?=(b+))\\2)"
+    assert not nullable
+
+    @pg.lazy
+    def recursive():
+        return pg.AllOf("a", pg.Optional(recursive))
+
+    with py.test.raises(pg.codegen.NotRegular):
+        pg.codegen.regex_for(recursive)
+
+    with py.test.raises(pg.codegen.NotRegular):
+        pg.codegen.regex_for(pg.Many(pg.Optional("a")))
+
+def test_compile_left_recursion():
+    number = pg.NamedPattern('number', pg.Words("0123456789"))
+
+    @pg.lazy
+    def expr():
+        return pg.OneOf(
+            pg.AllOf(expr, pg.Ignore("-"), number),
+            number)
+
+    assert_compiles(expr, "1-2-3")
+    assert_compiles(expr, "1-2-", 'expr')
+
+def test_compile_deferred():
+    words = pg.NamedPattern('words', pg.Words(pg.CharClass("a-z ")))
+    pattern = pg.Many(pg.Deferred(words), pg.Ignore("\n"))
+
+    assert_compiles(pattern, "one two\nthree\n")
+    compiled = pg.compile(pattern)
+    match, rest = compiled("one\ntwo")
+    assert isinstance(match[1].pattern, pg.codegen.Compiled)
+    assert pg.expand(match) == ['', ['words', "one"], ['words', "two"]]
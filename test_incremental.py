@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import py
+
+import pegger as pg
+from test_pegger import get_document
+
+
+data = "One\nTwo\n\n* Three\n  Four\n\n  More\n\nFive\n\n* Six\n"
+
+def test_parse():
+    "Test that parse matches the same as parse_string"
+    document = get_document()
+    parsed = pg.parse(data, document)
+    assert parsed.match == pg.parse_string(data, document)
+    assert parsed.reused == 0
+
+    py.test.raises(pg.NoPatternFound, pg.parse, "*", pg.Text("-"))
+
+def check_reparse(edit):
+    document = get_document()
+    start, old_end, new_text = edit
+    expected = pg.parse_string(data[:start] + new_text + data[old_end:], document)
+    reparsed = pg.reparse(pg.parse(data, document), edit)
+    assert reparsed.match == expected
+    assert reparsed.reused > 0
+
+def test_reparse():
+    "Test that reparse matches the same as parsing the edited text"
+    # Inserting into a paragraph
+    yield check_reparse, (1, 1, "ne O")
+    # Deleting a line of an indented block
+    yield check_reparse, (18, 25, "")
+    # Indenting a paragraph into an item
+    yield check_reparse, (33, 33, "  ")
+    # Turning a paragraph into an item
+    yield check_reparse, (0, 0, "* ")
+    # Replacing across blocks
+    yield check_reparse, (6, 12, "o\n\n* T")
+    # Appending to the end
+    yield check_reparse, (len(data), len(data), "Seven\n")
+
+def test_reparse_dispatch():
+    "Test that a OneOf that failed on the next character is matched again"
+    grammar = pg.OneOf(pg.AllOf("a", pg.OneOf("b", "c")), "a")
+    reparsed = pg.reparse(pg.parse("ax", grammar), (1, 1, "b"))
+    assert reparsed.match == pg.parse_string("abx", grammar)
+    assert reparsed.match == ['', "a", "b"]
+
+def test_reparse_shifts():
+    "Test that blocks after the edit are moved to the new text"
+    document = get_document()
+    parsed = pg.parse(data, document)
+    reparsed = pg.reparse(parsed, (0, 3, "First"))
+    text = reparsed.text
+    assert text == "First" + data[3:]
+    six = text.index("* Six")
+    block, = [block for block in reparsed.blocks if block[0] == six]
+    assert block[1] == len(text)
+    assert block[2] > len(text)
+    assert block[3] == [['item', "Six"]]
+    # Only the first block looked at the edit
+    assert reparsed.reused == len(parsed.blocks) - 1
+
+def test_reparse_shifts_results():
+    "Test that results after the edit are moved to the new text"
+    document = pg.AllOf(get_document())
+    parsed = pg.parse(data, document)
+    assert parsed.blocks is None
+    reparsed = pg.reparse(parsed, (0, 3, "First"))
+    text = reparsed.text
+    six = text.index("* Six")
+    (result, examined), = [
+        entry for (pattern, name), entry in reparsed.results[six].items()
+        if getattr(pattern, 'name', None) == 'item']
+    assert result[1] is text
+    assert result[2] == len(text)
+    assert result[0] == ['item', "Six"]
+    assert examined > len(text)
+    assert reparsed.match == pg.parse_string(text, document)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import tempfile
 import unittest
+import StringIO
 
 import py
 
@@ -60,6 +64,55 @@ def test_match_words():
     assert rest == ""
 
 
+def test_match_words_char_class():
+    "Test that Words can be given a CharClass of letters"
+    identifier = pg.Words(pg.CharClass("a-zA-Z0-9_"))
+
+    match, rest = identifier("some_name2 = 1", 'identifier')
+    assert match == ['identifier', "some_name2"]
+    assert rest == " = 1"
+
+    line = pg.Words(pg.CharClass("^\n"))
+
+    match, rest = line("A line, of anything!\nNext", 'line')
+    assert match == ['line', "A line, of anything!"]
+    assert rest == "\nNext"
+
+    with py.test.raises(pg.NoPatternFound):
+        line("\nNext", 'line')
+
+def test_char_class():
+    char_class = pg.CharClass("a-c_-")
+    for char in "abc_-":
+        assert char in char_class
+    for char in "dA^":
+        assert char not in char_class
+    assert char_class.regex() == "[\\-\\_a-c]"
+
+    negated = pg.CharClass("^a-c")
+    assert "a" not in negated
+    assert "d" in negated
+    assert negated.regex() == "[^a-c]"
+
+    # A spec of just "^" isn't negated, as there is nothing to negate
+    caret = pg.CharClass("^")
+    assert "^" in caret
+    assert "a" not in caret
+    assert caret.regex() == "[\\^]"
+    assert pg.CharClass("").regex() == "[^\\s\\S]"
+
+def test_match_long_words():
+    "Test that long runs of letters are matched"
+    data = "a" * 100000 + "1"
+
+    match, rest = pg.Words()(data, 'words')
+    assert match == ['words', data[:-1]]
+    assert rest == "1"
+
+    match, rest = pg.Some("a")(data, 'some')
+    assert match == ['some', data[:-1]]
+    assert rest == "1"
+
 def test_match_all_of():
     letter_a = pg.NamedPattern(
         'letter_a',
@@ -668,6 +721,96 @@ foo
     assert match == expected
     assert rest == "bar\nbaz\n"
 
+def test_lazy():
+    "Test that lazy patterns are only built once"
+    built = []
+
+    @pg.lazy
+    def letters():
+        built.append(True)
+        return pg.Many(pg.NamedPattern('a', "a"), bracketed)
+
+    # bracketed is defined after letters, and refers back to it
+    @pg.lazy
+    def bracketed():
+        return pg.AllOf(
+            pg.Ignore("("),
+            letters,
+            pg.Ignore(")"))
+
+    data = "a(a(aa))a"
+    expected = [
+        'letters',
+        ['a', "a"],
+        ['bracketed',
+         ['letters',
+          ['a', "a"],
+          ['bracketed',
+           ['letters', ['a', "a"], ['a', "a"]]]]],
+        ['a', "a"]]
+
+    assert pg.parse_string(data, letters) == expected
+    assert pg.parse_string(data, letters) == expected
+    assert len(built) == 1
+
+    anonymous = pg.lazy(lambda: pg.Text("a"))
+    match, rest = anonymous("ab")
+    assert match == ['', "a"]
+
+def test_match_lookahead_prefix():
+    "Test that Lookahead skips to where its pattern could start"
+    footnote = pg.Lookahead(
+        pg.NamedPattern(
+            'footnote',
+            pg.AllOf(
+                pg.Ignore("[^"),
+                pg.Words(),
+                pg.Ignore("]"))))
+
+    data = "A long paragraph [ with [^a note] in it" + " and more" * 10000
+    match, rest = footnote(data, 'footnotes')
+    assert match == ['footnotes', ['footnote', "a note"]]
+    assert rest == "A long paragraph [ with  in it" + " and more" * 10000
+
+    with py.test.raises(pg.NoPatternFound):
+        footnote("No [notes] here", 'footnotes')
+
+def test_match_lookahead_view():
+    "Test that Lookahead leaves out its match from a view of the text"
+    footnote = pg.Lookahead(pg.AllOf(pg.Ignore(" [^"), pg.Words(), pg.Ignore("]")))
+    data = "Some [^note] text"
+    match, text, end = footnote.match_at(data, 0, 'note')
+    assert match == ['note', "note"]
+    assert type(text) is pg.IndentedText
+    assert text.text is data
+    assert text[end:] == "Some text"
+
+    grammar = pg.Many(pg.AllOf(footnote, pg.Words(), pg.Ignore("\n")))
+    match, rest = grammar("One [^a]\nTwo [^b]\n")
+    assert match == ['', "a", "One", "b", "Two"]
+    assert rest == ""
+
+def test_required_prefix():
+    def do_test(pattern, expected):
+        assert pg.pegger._required_prefix(pattern) == expected
+
+    @pg.lazy
+    def recursive():
+        return pg.AllOf(recursive, "a")
+
+    items = [
+        (pg.Text("ab"), "ab"),
+        (pg.NamedPattern('a', pg.AllOf(pg.Ignore("[^"), pg.Words())), "[^"),
+        (pg.CountOf(2, "-"), "-"),
+        (pg.AllOf(pg.Optional("a"), "b"), ""),
+        (pg.OneOf("a", "b"), ""),
+        (pg.Words(), ""),
+        (recursive, ""),
+        ]
+
+    for pattern, expected in items:
+        yield do_test, pattern, expected
+
 def test_parse_string_a():
     letter_a = pg.NamedPattern("letter_a", "a")
 
@@ -853,6 +996,21 @@ def test_optional():
         ['letters', "bc"]]
     assert expected == result
 
+def test_indented_rest():
+    "Test that the rest after an Indented is the original text"
+    match, rest = pg.Indented(pg.Words("a"))("  a\n\n  b")
+    assert rest == "\n\n  b"
+
+    grammar = pg.AllOf(
+        pg.OneOf(
+            pg.Indented(pg.Not(pg.Words("*b")))),
+        pg.OneOf(
+            pg.Indented(pg.Some("\n"), optional=True),
+            pg.Optional(pg.Words("\nb"))))
+    match, rest = grammar("  a\n\n  *b\n a")
+    assert match == ['', "a", "\n\n"]
+    assert rest == "  *b\n a"
+
 def test_indented():
     list_item = pg.NamedPattern(
         'list_item',
@@ -985,6 +1143,30 @@ def test_add_match_to_result():
     for item in items:
         yield do_test, item
 
+def test_is_transparent():
+    "Test that whether each name is transparent is only worked out once"
+    result = ["useful_name"]
+    pg.pegger._add_match_to_result(result, ['named', "flimmle"])
+    pg.pegger._add_match_to_result(result, ['_hidden', "flammle"])
+    assert result == ["useful_name", ['named', "flimmle"], "flammle"]
+    assert pg.pegger._transparent_names['_hidden'] is True
+    assert pg.pegger._transparent_names['named'] is False
+    assert pg.pegger._is_transparent('')
+
+def test_has_text():
+    "Test that _has_text agrees with utils.deep_bool"
+    matches = [
+        [], [''], ['', ''], ['name'], ['', "text"], ['', '', "text"],
+        ['', ['', '']], ['', ['', ['', "text"]]], ['', u"", u"text"]]
+    for match in matches:
+        assert pg.pegger._has_text(match) == pg.utils.deep_bool(match)
+
+def test_filter_match_name():
+    "Test that filter_match can rename the match it filters"
+    match = ['', "a", "b", ['c', "d"], "e"]
+    assert pg.filter_match(match, name='joined') == ['joined', "ab", ['c', "d"], "e"]
+    assert pg.Join(pg.AllOf("a", "b"))("ab", 'joined') == (['joined', "ab"], "")
+
 def test_get_current_indentation_initial_indent():
     indented_text = pg.Indented(
         pg.Words(),
@@ -1042,3 +1224,580 @@ def test_get_indented_lines():
 
     for indent, data, expected in items:
         yield do_test, indent, data, expected
+
+def test_match_at():
+    "Test that match_at matches at an offset and returns the end offset"
+    letter_a = pg.Text("a")
+    data = "bab"
+
+    match, text, end = letter_a.match_at(data, 1, 'letter_a')
+    assert match == ['letter_a', "a"]
+    assert text is data
+    assert end == 2
+
+    assert letter_a.match_at(data, 2, 'letter_a') is None
+
+    word_ab = pg.AllOf(
+        pg.NamedPattern('a', "a"),
+        pg.Many(pg.Not("x")))
+
+    match, text, end = word_ab.match_at("xxabcx", 2, 'word_ab')
+    assert match == ['word_ab', ['a', "a"], "b", "c"]
+    assert end == 5
+
+def test_match_at_indented():
+    "Test that Indented gives an offset into the original text"
+    paragraph = pg.Indented(
+        pg.Many(
+            pg.Words(),
+            pg.Text("\n")))
+
+    data = "xx\n  One\n\n  Two\nThree"
+    match, text, end = paragraph.match_at(data, 3, 'paragraph')
+    assert match == ['paragraph', "One", "\n", "\n", "Two"]
+    assert text is data
+    assert data[end:] == "\nThree"
+
+def test_indented_text():
+    "Test that IndentedText looks like the joined lines"
+    data = "xx\n  One\n\n  Two three\nFour"
+    spans = [(5, 8), (9, 9), (12, 21)]
+    joined = "One\n\nTwo three"
+    view = pg.IndentedText(data, spans)
+    assert len(view) == len(joined)
+    assert view == joined
+    assert [view[i] for i in range(len(view))] == list(joined)
+    for start in range(len(joined) + 1):
+        for stop in range(start, len(joined) + 1):
+            assert view[start:stop] == joined[start:stop]
+        for sub in ["\n", "T", "e", "ree", "e\n", "\nTwo"]:
+            assert view.find(sub, start) == joined.find(sub, start)
+        for prefix in ["", "O", "One\n", "\n\nT", "thr"]:
+            assert view.startswith(prefix, start) == joined.startswith(prefix, start)
+    assert [view.original_offset(i) for i in [0, 3, 4, 5, 14]] == [5, 8, 9, 12, 21]
+    assert view.view_offset(12) == 5
+    assert view[14:20] == ""
+    assert not view.startswith("e\n", 13)
+
+def test_indented_text_match():
+    "Test that regexes match an IndentedText as if it were joined"
+    view = pg.IndentedText("  ab\n  ba\n  cd", [(2, 4), (7, 9), (12, 14)])
+    letters = re.compile("[ab]+")
+    lines = re.compile("[ab\n]+")
+    found = view.match(letters, 0, True)
+    assert (found.group(), found.end()) == ("ab", 2)
+    found = view.match(lines, 1, True)
+    assert (found.group(), found.end()) == ("b\nba\n", 6)
+    found = view.match(re.compile("a(?=b)"), 0)
+    assert (found.group(), found.end()) == ("a", 1)
+    assert view.match(letters, 6, True) is None
+
+def test_indented_text_select():
+    "Test that a view can leave out part of the text without copying it"
+    data = "one two\n  three four"
+    view = pg.IndentedText(data, [(0, len(data))], [])
+    spliced = view.select([(0, 4), (8, len(data))], "")
+    assert spliced == "one   three four"
+    assert spliced.text is data
+    assert spliced.spans == [(0, 4), (8, len(data))]
+    assert spliced.find("three") == 6
+    assert spliced.original_offset(5) == 9
+    found = spliced.match(re.compile("[a-z ]+"), 0, True)
+    assert (found.group(), found.end()) == ("one   three four", 16)
+
+    lines = spliced.select(pg.pegger._get_indented_spans(spliced, 4, "  "), "\n")
+    assert lines == "three four"
+    assert lines.original_offset(0) == 10
+
+def test_match_at_nested_indented():
+    "Test that nested Indented patterns give offsets into the original text"
+    @pg.lazy
+    def block():
+        return pg.Indented(
+            pg.Many(
+                pg.Words(pg.CharClass("a-zA-Z")),
+                pg.Text("\n"),
+                block),
+            optional=True)
+
+    data = "One\n  Two\n    Three\n  Four\nFive"
+    match, text, end = pg.AllOf(pg.Words(), "\n", block).match_at(data, 0)
+    assert text is data
+    assert data[end:] == "\nFive"
+    assert match == [
+        "", "One", "\n",
+        ['block',
+         "Two", "\n",
+         ['block', "Three"],
+         "\n", "Four"]]
+
+def test_match_function():
+    "Test that plain callables can still be used as patterns"
+    def letter_a(text, name=""):
+        return pg.Text("a")(text, name or 'letter_a')
+
+    letters = pg.Many(letter_a, "b")
+
+    match, rest = letters("abac", 'letters')
+    assert match == ['letters', ['letter_a', "a"], "b", ['letter_a', "a"]]
+    assert rest == "c"
+
+def test_parse_string_memoize():
+    "Test that memoizing doesn't rematch patterns at the same position"
+    calls = []
+    def letter_x(text):
+        calls.append(text)
+        return pg.Text("x")(text)
+
+    @pg.lazy
+    def nested():
+        return pg.OneOf(
+            pg.AllOf("(", nested, ")", "!"),
+            pg.AllOf("(", nested, ")"),
+            letter_x)
+
+    data = "(" * 8 + "x" + ")" * 8
+    expected = pg.parse_string(data, nested)
+    assert len(calls) == 2 ** 8
+
+    calls = []
+    result = pg.parse_string(data, nested, memoize=True)
+    assert result == expected
+    assert len(calls) == 1
+
+    with py.test.raises(pg.NoPatternFound):
+        pg.parse_string("((x)", nested, memoize=True)
+
+def test_parse_string_memoize_indented():
+    "Test that memoizing works on the lines of an Indented"
+    calls = []
+    def letter_x(text):
+        calls.append(text)
+        return pg.Text("x")(text)
+
+    @pg.lazy
+    def nested():
+        return pg.OneOf(
+            pg.AllOf("(", nested, ")", "!"),
+            pg.AllOf("(", nested, ")"),
+            letter_x)
+
+    grammar = pg.OneOf(
+        pg.AllOf(pg.Indented(nested), "?"),
+        pg.Indented(nested))
+    data = "  " + "(" * 8 + "x" + ")" * 8
+    expected = pg.parse_string(data, grammar)
+
+    calls = []
+    result = pg.parse_string(data, grammar, memoize=True)
+    assert result == expected
+    assert len(calls) == 1
+
+def test_memo_window():
+    "Test that the memo only keeps the most recent positions"
+    letter_a = pg.Text("a")
+    memo = pg.Memo("aaaa", window=2)
+    match_at = memo.wrap(pg.Text.match_at)
+
+    for pos in range(4):
+        match_at(letter_a, "aaaa", pos)
+    assert sorted(memo.positions.keys()) == [2, 3]
+    assert memo.positions[3] == {(letter_a, ""): (["", "a"], "aaaa", 4)}
+
+def test_wrap_grammar():
+    "Test that only the copy of a wrapped grammar is changed"
+    calls = []
+    def wrapper(match_at):
+        def counted(pattern, text, pos, name=""):
+            calls.append(pattern.original)
+            return match_at(pattern, text, pos, name)
+        return counted
+
+    letter = pg.Text("a")
+    grammar = pg.Many(letter, "b")
+    wrapped = pg.wrap_grammar(grammar, wrapper)
+    assert wrapped.original is grammar
+    assert wrapped("ab") == (['', "a", "b"], "")
+    assert calls == [grammar, letter, grammar.options[1]]
+
+    calls = []
+    assert grammar("ab") == (['', "a", "b"], "")
+    assert calls == []
+
+    # Wrapping a wrapped grammar wraps its wrappers
+    twice = pg.wrap_grammar(wrapped, wrapper)
+    assert twice.original is grammar
+    twice("a")
+    assert calls == [grammar, grammar, letter, letter]
+
+def test_parse_chunks():
+    "Test that parse_chunks yields a match per record, across chunks"
+    record = pg.NamedPattern(
+        'record',
+        pg.AllOf(
+            pg.Words(),
+            pg.Ignore("\n")))
+    data = "One two\nThree\nFour five six\n"
+    chunks = [data[i:i+3] for i in range(0, len(data), 3)]
+
+    expected = [
+        ['record', "One two"],
+        ['record', "Three"],
+        ['record', "Four five six"]]
+
+    assert list(pg.parse_chunks(chunks, pg.Many(record), lookahead=1)) == expected
+    assert list(pg.parse_chunks(chunks, record, lookahead=1)) == expected
+    records = pg.NamedPattern('records', pg.Many(record))
+    assert list(pg.parse_chunks(chunks, records, lookahead=1)) == expected
+    assert list(pg.parse_chunks([], record)) == []
+
+    with py.test.raises(pg.NoPatternFound):
+        list(pg.parse_chunks(chunks + ["!"], record, lookahead=1))
+
+def test_parse_stream():
+    "Test that parse_stream reads records from a file"
+    record = pg.NamedPattern(
+        'record',
+        pg.AllOf(
+            pg.Words(),
+            pg.Ignore("\n")))
+    data = StringIO.StringIO("Line one\n" * 100)
+
+    matches = list(pg.parse_stream(data, pg.Many(record), chunk_size=7, lookahead=2))
+    assert matches == [['record', "Line one"]] * 100
+
+def test_parse_file():
+    "Test that parse_file matches against the mapped file"
+    words = pg.Words(pg.CharClass("a-zA-Z"))
+    lines = pg.Many(
+        words,
+        pg.Indented(
+            pg.Many(
+                words,
+                pg.Text("\n"))),
+        pg.Text("\n"))
+    data = "One\n  Two\n  Three\nFour\n"
+    path = tempfile.mktemp()
+    try:
+        with open(path, "wb") as f:
+            f.write(data)
+        expected = pg.parse_string(data, lines)
+        assert expected == ['', "One", "\n", "Two", "\n", "Three", "\n", "Four", "\n"]
+        assert pg.parse_file(path, lines) == expected
+
+        match = pg.parse_file(path, lines, encoding="utf-8")
+        assert match == expected
+        assert isinstance(match[1], unicode)
+
+        assert pg.parse_file(path, lines, compact=True).to_list() == expected
+
+        open(path, "wb").close()
+        with py.test.raises(pg.NoPatternFound):
+            pg.parse_file(path, lines)
+    finally:
+        os.remove(path)
+
+def test_left_recursion():
+    "Test that left recursive rules give left associative matches"
+    number = pg.NamedPattern('number', pg.Words("0123456789"))
+
+    @pg.lazy
+    def expr():
+        return pg.OneOf(
+            pg.AllOf(expr, pg.Ignore("-"), number),
+            number)
+
+    expected = [
+        'expr',
+        ['expr',
+         ['expr', ['number', "1"]],
+         ['number', "2"]],
+        ['number', "3"]]
+
+    assert pg.parse_string("1-2-3", expr) == expected
+    assert pg.parse_string("1-2-3", expr, memoize=True) == expected
+    assert expr.left_recursive is True
+
+    match, rest = expr("1-2-", 'expr')
+    assert rest == "-"
+
+def test_left_recursion_named():
+    "Test that a left recursive reference can be given another name"
+    num = pg.NamedPattern('num', pg.Words("0123456789"))
+    expr = pg.lazy(lambda: pg.OneOf(
+        pg.AllOf(pg.NamedPattern('left', expr), pg.Ignore("-"), num),
+        num))
+    expr.name = 'expr'
+
+    expected = [
+        'expr',
+        ['left',
+         ['left', ['num', "1"]],
+         ['num', "2"]],
+        ['num', "3"]]
+
+    assert pg.parse_string("1-2-3", expr) == expected
+    assert pg.parse_string("1-2-3", expr, memoize=True) == expected
+    assert pg.compile(expr).match("1-2-3") == (expected, "")
+
+def test_indirect_left_recursion():
+    "Test that rules that are left recursive through each other grow"
+    number = pg.NamedPattern('number', pg.Words("0123456789"))
+
+    @pg.lazy
+    def sum():
+        return pg.OneOf(
+            pg.AllOf(product, pg.Ignore("+"), number),
+            number)
+
+    @pg.lazy
+    def product():
+        return pg.OneOf(
+            pg.AllOf(sum, pg.Ignore("*"), number),
+            number)
+
+    expected = [
+        'sum',
+        ['product',
+         ['sum',
+          ['product', ['number', "1"]],
+          ['number', "2"]],
+         ['number', "3"]],
+        ['number', "4"]]
+
+    assert pg.parse_string("1+2*3+4", sum) == expected
+    assert pg.parse_string("1+2*3+4", sum, memoize=True) == expected
+
+def get_sentences():
+    "A grammar for test_parse_many, which its workers build"
+    @pg.lazy
+    def sentence():
+        return pg.AllOf(
+            pg.Words(pg.CharClass("a-zA-Z ")),
+            pg.Ignore("."))
+    return pg.Many(sentence)
+
+def test_parse_many():
+    "Test parsing texts in worker processes"
+    texts = ["One. Two.", "Three.", "Four. Five. Six."]
+    expected = [pg.parse_string(text, get_sentences()) for text in texts]
+
+    assert list(pg.parse_many(texts, get_sentences, workers=2, chunksize=1)) == expected
+    assert list(pg.parse_many(texts, get_sentences(), workers=2)) == expected
+    assert sorted(pg.parse_many(texts, get_sentences, workers=2, ordered=False)) == list(enumerate(expected))
+
+    with py.test.raises(pg.NoPatternFound):
+        list(pg.parse_many(["One.", "!"], get_sentences, workers=2))
+
+def get_document():
+    "A grammar for test_parse_blocks"
+    words = pg.Words(pg.CharClass("a-zA-Z "))
+    line = pg.AllOf(words, pg.Ignore(pg.Optional("\n")))
+    item = pg.NamedPattern(
+        'item',
+        pg.AllOf(
+            pg.Ignore("* "),
+            line,
+            pg.Optional(
+                pg.Indented(
+                    pg.Many(
+                        line,
+                        pg.Ignore("\n"))))))
+    paragraph = pg.NamedPattern('paragraph', pg.Many(line))
+    return pg.NamedPattern(
+        'document',
+        pg.Many(
+            item,
+            paragraph,
+            pg.Ignore("\n")))
+
+def test_split_blocks():
+    "Test that text is split after blank lines"
+    data = "One\n\n* Two\n\n  Three\n\nFour"
+    assert pg.split_blocks(data, chunk_size=1) == ["One\n\n", "* Two\n\n  Three\n\n", "Four"]
+    assert pg.split_blocks(data, chunk_size=8) == ["One\n\n* Two\n\n  Three\n\n", "Four"]
+    assert pg.split_blocks(data, "\n\n", chunk_size=1) == [
+        "One\n\n", "* Two\n\n", "  Three\n\n", "Four"]
+    assert pg.split_blocks("") == [""]
+
+def test_parse_blocks():
+    "Test that parsing blocks in parallel gives the same match"
+    data = "One\nTwo\n\n* Three\n  Four\n\n  More\n\nFive\n\n\n* Six\n" * 5
+    expected = pg.parse_string(data, get_document())
+
+    assert expected[2] == ['item', "Three", "Four", "More"]
+    assert pg.parse_blocks(data, get_document, workers=2, chunk_size=1) == expected
+    assert pg.parse_blocks(data, get_document(), workers=2, chunk_size=20) == expected
+    # A chunk ending in "*" doesn't match, so the whole text is parsed
+    assert pg.parse_blocks(data, get_document, workers=2, boundary="\\*", chunk_size=1) == expected
+
+def get_headings(deferred):
+    "A grammar of headings and lines, with the lines optionally deferred"
+    emphasis = pg.NamedPattern(
+        'emphasis',
+        pg.AllOf(
+            pg.Ignore("*"),
+            pg.Words(pg.CharClass("a-zA-Z ")),
+            pg.Ignore("*")))
+    inline = pg.Many(
+        emphasis,
+        pg.Words(pg.CharClass("a-zA-Z ")))
+    heading = pg.NamedPattern(
+        'heading',
+        pg.AllOf(
+            pg.Ignore("# "),
+            pg.Words(pg.CharClass("a-zA-Z "))))
+    line = pg.NamedPattern('line', inline)
+    if deferred:
+        line = pg.Deferred(line)
+    return pg.NamedPattern(
+        'document',
+        pg.Many(
+            heading,
+            line,
+            pg.Ignore("\n")))
+
+def test_deferred():
+    "Test that a deferred pattern is only matched when it is used"
+    data = "# Title\nOne *two*\nThree\n"
+    match = pg.parse_string(data, get_headings(deferred=True))
+
+    assert match[1] == ['heading', "Title"]
+    assert isinstance(match[2], pg.DeferredMatch)
+    assert match[2].text == "One *two*"
+    assert match[2]._match is None
+    assert match[2].match == ['line', "One ", ['emphasis', "two"]]
+    assert match[2] == ['line', "One ", ['emphasis', "two"]]
+    assert pg.expand(match) == pg.parse_string(data, get_headings(deferred=False))
+
+    # The inner pattern can fail once it is used
+    match = pg.parse_string("# Title\nOne *two\n", get_headings(deferred=True))
+    py.test.raises(pg.NoPatternFound, lambda: match[2].match)
+
+def test_deferred_span():
+    "Test a deferred pattern whose extent is found by another pattern"
+    words = pg.Words(pg.CharClass("a-z"))
+    pattern = pg.Many(
+        pg.Deferred(
+            pg.NamedPattern('pair', pg.AllOf(words, pg.Ignore("="), words)),
+            pg.AllOf("(", pg.Many(pg.Not(")")), ")")),
+        pg.Ignore(" "))
+    match = pg.parse_string("(a=b) (c=d)", pattern)
+
+    assert [item.text for item in match[1:]] == ["(a=b)", "(c=d)"]
+    assert pg.DeferredMatch(words, "abc").match == ['', "abc"]
+    assert pg.Deferred(words).match_at("abc\n", 3) is None
+
+def test_deferred_escaped_joined():
+    "Test that Escaped and Join work on deferred matches"
+    letters = pg.Words("ab<")
+    match = pg.parse_string("a<b", pg.Escaped(pg.Deferred(letters)))
+    assert pg.expand(match) == pg.parse_string("a<b", pg.Escaped(letters))
+    assert pg.expand(match) == ['', "a&lt;b"]
+
+    escaped_twice = pg.do_escape(pg.do_escape(pg.DeferredMatch(letters, "a<")))
+    assert escaped_twice.match == ['', "a&amp;lt;"]
+
+    assert pg.parse_string("ab", pg.Join(pg.Deferred(pg.Words("ab")))) == ['', "ab"]
+    assert pg.parse_string("ab", pg.Join(pg.AllOf("a", pg.Deferred("b")))) == ['', "ab"]
+
+def build_from_events(events):
+    "Build the match that a list of events came from"
+    stack = [[""]]
+    for event in events:
+        if event[0] == "start":
+            stack.append([event[1]])
+        elif event[0] == "text":
+            stack[-1].append(event[1])
+        else:
+            match = stack.pop()
+            stack[-1].append(match)
+    return stack[0][1]
+
+def test_iter_events():
+    "Test that the events of a parse describe its match"
+    data = "One\nTwo\n\n* Three\n  Four\n\nFive"
+    document = get_document()
+    events = list(pg.iter_events(data, document))
+
+    assert events[:4] == [
+        ("start", 'document', 0),
+        ("start", 'paragraph', 0),
+        ("text", "One"),
+        ("text", "Two")]
+    assert ("start", 'item', 9) in events
+    assert ("end", 'item', 23) in events
+    assert events[-1] == ("end", 'document', len(data))
+    assert build_from_events(events) == pg.parse_string(data, document)
+    assert events == list(pg.parse_string(data, document, compact=True).events())
+
+    # Other patterns are matched before their events are given
+    words = pg.NamedPattern('words', pg.Words())
+    assert list(pg.iter_events("one", words)) == [
+        ("start", 'words', 0), ("text", "one"), ("end", 'words', 3)]
+
+    py.test.raises(pg.NoPatternFound, list, pg.iter_events("*", document))
+
+def test_iter_events_positions():
+    "Test that the positions of events aren't thrown by inserted or ignored text"
+    grammar = pg.NamedPattern(
+        'r',
+        pg.Many(
+            pg.AllOf(
+                pg.Insert("b"),
+                pg.Ignore("-"),
+                pg.NamedPattern('x', "a"),
+                pg.NamedPattern('y', pg.Insert("a")),
+                pg.NamedPattern('z', "b"))))
+    assert list(pg.iter_events("-ab-ab", grammar)) == [
+        ("start", 'r', 0),
+        ("text", "b"),
+        ("start", 'x', 1), ("text", "a"), ("end", 'x', 2),
+        ("start", 'y', 2), ("text", "a"), ("end", 'y', 2),
+        ("start", 'z', 2), ("text", "b"), ("end", 'z', 3),
+        ("text", "b"),
+        ("start", 'x', 4), ("text", "a"), ("end", 'x', 5),
+        ("start", 'y', 5), ("text", "a"), ("end", 'y', 5),
+        ("start", 'z', 5), ("text", "b"), ("end", 'z', 6),
+        ("end", 'r', 6)]
+
+    assert list(pg.iter_events("x", pg.Optional("a"))) == []
+
+def test_iter_events_commits():
+    "Test that each block's events are given before the next is matched"
+    matched = []
+    def record(text):
+        matched.append(len(text))
+        raise pg.NoPatternFound
+    pattern = pg.Many(pg.Function(record), pg.NamedPattern('line', pg.Words("ab\n")))
+    events = pg.iter_events("ab\nba", pattern)
+
+    assert next(events) == ("start", 'line', 0)
+    assert matched == [5]
+
+def test_until():
+    "Test that Until matches the same text as Join(Many(Not(pattern)))"
+    data = "one *two* _three_ **four"
+    for terminator in ["*", "**", pg.OneOf("_", "*"),
+                       pg.AllOf("*", pg.Words()), pg.Function(pg.Text("r"))]:
+        until = pg.Until(terminator)
+        expected = pg.Join(pg.Many(pg.Not(terminator)))
+        for pos in range(len(data) + 1):
+            assert until.match_at(data, pos, 'text') == expected.match_at(data, pos, 'text')
+
+    assert pg.Until("*").match_at(data, 0) == (['', "one "], data, 4)
+    until = pg.Until(pg.OneOf("_", "*"))
+    assert until("a_", "text") == (['text', "a"], "_")
+    assert until.prefix == ""
+    assert until.scanner.search("ab_") is not None
+    assert pg.Until("x")("abc") == (['', "abc"], "")
+    py.test.raises(pg.NoPatternFound, pg.Until("*"), "*a")
+    py.test.raises(pg.NoPatternFound, pg.Until("*"), "")
+
+def test_until_indented():
+    "Test Until against an indented block"
+    pattern = pg.AllOf(
+        "a:\n",
+        pg.Indented(pg.Many(pg.NamedPattern('line', pg.Until(pg.OneOf("\n", ";"))), "\n", ";")))
+    match, rest = pattern("a:\n  b c;d\n  e")
+    assert match == ['', "a:\n", ['line', "b c"], ";", ['line', "d"], "\n", ['line', "e"]]
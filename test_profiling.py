@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import py
+
+import pegger as pg
+
+
+def get_grammar():
+    words = pg.NamedPattern('words', pg.Words(pg.CharClass("a-z ")))
+    bold = pg.NamedPattern('bold', pg.AllOf(pg.Ignore("*"), words, pg.Ignore("*")))
+    return pg.Many(bold, words)
+
+def by_label(found):
+    return dict((stats.label, stats) for stats in found.stats.values())
+
+def test_profile():
+    "Test that the calls and matches of each pattern are counted"
+    found = pg.profile("one *two* three", get_grammar())
+    stats = by_label(found)
+
+    assert found.match[0] == ""
+    assert stats["Many"].calls == 1
+    assert stats["Many"].consumed == 15
+    # Only the options that can start with the next character are tried
+    assert stats["NamedPattern 'bold'"].calls == 1
+    assert stats["NamedPattern 'words'"].matches == 3
+    assert stats["NamedPattern 'words'"].consumed == 13
+    assert stats["AllOf in 'bold'"].consumed == 5
+
+    one_of = pg.OneOf("ab", "ac")
+    found = pg.Profile()
+    profiled = found.instrument(one_of)
+    pg.parse_string("ac", profiled)
+    stats = by_label(found)
+    assert stats["Text 'ab'"].calls == 1
+    assert stats["Text 'ab'"].failures == 1
+    assert stats["Text 'ac'"].matches == 1
+    assert stats["Text 'ac'"].pattern is one_of.options[1]
+
+    # Only parses with the instrumented copy are recorded
+    pg.parse_string("ac", one_of)
+    assert stats["Text 'ab'"].calls == 1
+    pg.parse_string("ac", profiled)
+    assert stats["Text 'ab'"].calls == 2
+
+def test_profile_times():
+    "Test that own time leaves out the time spent in sub-patterns"
+    ticks = iter(range(100))
+    found = pg.profile("a", pg.NamedPattern('word', pg.Words()), timer=lambda: next(ticks))
+    named, = [s for s in found.stats.values() if type(s.pattern) is pg.NamedPattern]
+    words, = [s for s in found.stats.values() if type(s.pattern) is pg.Words]
+
+    assert (named.total, named.own) == (3, 2)
+    assert (words.total, words.own) == (1, 1)
+
+def test_report():
+    "Test the report and dump of a profile"
+    found = pg.profile("one *two* three", get_grammar())
+    report = found.report(sort="consumed", limit=2)
+    lines = report.splitlines()
+
+    assert len(lines) == 3
+    assert lines[0].split() == ["calls", "matches", "failures", "total", "own",
+                                "consumed", "pattern"]
+    assert lines[1].endswith(" Many")
+    dumped = json.loads(json.dumps(found.dump(sort="consumed")))
+    assert dumped[0]["pattern"] == "Many"
+    assert dumped[0]["consumed"] == 15
+    assert dumped[1]["consumed"] == 13
+    py.test.raises(ValueError, found.report, sort="name")
+
+def test_backtracking():
+    "Test that failed options, and repeated attempts, are found"
+    words = pg.Words(pg.CharClass("a-z"))
+    grammar = pg.Many(
+        pg.NamedPattern('shout', pg.AllOf(words, "!")),
+        pg.NamedPattern('plain', words),
+        pg.Ignore("\n"))
+    data = "hello\nhi!\nthere"
+    found = pg.backtracking(data, grammar)
+
+    assert found.heatmap()[0][1] == 5
+    assert found.heatmap()[1][1] == 0
+    assert found.heatmap()[2][1] == 5
+    assert found.repeated()[0] > 0
+    assert 3 not in found.repeated()
+    waste, = found.wasteful_options()
+    assert waste.label == "NamedPattern 'shout'"
+    assert (waste.failures, waste.wasted, waste.longest) == (2, 10, 5)
+    lines = found.report(limit=2).splitlines()
+    assert lines[1].split()[:3] == ["1", str(found.heatmap()[0][0]), "5"]
+    assert lines[1].endswith("hello")
+
+def test_backtracking_indented():
+    "Test that attempts in an indented block are counted in the text"
+    data = "a\n  b\n  c"
+    grammar = pg.AllOf("a\n", pg.Indented(pg.Many("b", "c", "\n")))
+    found = pg.backtracking(data, grammar)
+
+    assert found.attempts[4] > 0
+    assert found.attempts[8] > 0
+    assert [attempts > 0 for attempts, wasted in found.heatmap()] == [True, True, True]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import pegger as pg
+from pegger import tree
+
+
+def get_grammar():
+    words = pg.Words(pg.CharClass("a-zA-Z "))
+    emphasis = pg.NamedPattern(
+        'emphasis',
+        pg.AllOf(
+            pg.Ignore("*"),
+            words,
+            pg.Ignore("*")))
+    paragraph = pg.NamedPattern(
+        'paragraph',
+        pg.Many(
+            emphasis,
+            words))
+    return pg.NamedPattern(
+        'document',
+        pg.Many(
+            paragraph,
+            pg.Ignore(
+                pg.Many("\n")),
+            pg.Insert("<br>")))
+
+def test_compact():
+    "Test that a compact tree converts back to the same match"
+    data = "One *two* three\n\nFour"
+    document = get_grammar()
+    expected = pg.parse_string(data, document)
+    compacted = pg.parse_string(data, document, compact=True)
+
+    assert isinstance(compacted, pg.Tree)
+    assert compacted.to_list() == expected
+
+def test_compact_nodes():
+    "Test the nodes of a compact tree"
+    data = "One *two*\n\nFour"
+    compacted = pg.compact(
+        ['document',
+         ['paragraph', "One ", ['emphasis', "two"]],
+         "<br>",
+         ['paragraph', "Four"]],
+        data)
+
+    assert len(compacted) == 8
+    assert compacted.name(0) == 'document'
+    assert compacted.children(0) == [1, 5, 6]
+    assert [compacted.name(i) for i in compacted.children(1)] == [None, 'emphasis']
+    assert compacted.text(1) == "One *two"
+    assert compacted.text(3) == "two"
+    assert compacted.starts[3] == 5
+    assert compacted.kinds[2] == tree.SPAN
+    assert compacted.kinds[5] == tree.LITERAL
+    assert compacted.text(5) == "<br>"
+    assert compacted.text(6) == "Four"
+    assert compacted.to_list(1) == ['paragraph', "One ", ['emphasis', "two"]]
+    assert compacted.to_list(7) == "Four"
+
+def test_events():
+    "Test the events of a compact tree"
+    compacted = pg.compact(
+        ['document',
+         ['paragraph', "One ", ['emphasis', "two"]],
+         ['_inline', "Four"]],
+        "One *two*\n\nFour")
+
+    assert list(compacted.events()) == [
+        ("start", 'document', 0),
+        ("start", 'paragraph', 0),
+        ("text", "One "),
+        ("start", 'emphasis', 5),
+        ("text", "two"),
+        ("end", 'emphasis', 8),
+        ("end", 'paragraph', 8),
+        ("text", "Four"),
+        ("end", 'document', 15)]
+    assert list(compacted.events(2)) == [("text", "One ")]
+    assert list(compacted.events(3))[-1] == ("end", 'emphasis', 8)
+
+def test_compact_located():
+    "Test that the offsets of a located match are exact"
+    def spans(compacted):
+        return [(compacted.name(i), compacted.starts[i], compacted.ends[i])
+                for i in range(len(compacted))]
+
+    grammar = pg.NamedPattern(
+        'r',
+        pg.AllOf(
+            pg.Insert("b"),
+            pg.NamedPattern('x', "a"),
+            pg.NamedPattern('y', "b")))
+    compacted = pg.parse_string("ab", grammar, compact=True)
+    assert compacted.to_list() == ['r', "b", ['x', "a"], ['y', "b"]]
+    assert spans(compacted) == [
+        ('r', 0, 2), (None, 0, 0), ('x', 0, 1), (None, 0, 1), ('y', 1, 2), (None, 1, 2)]
+    assert compacted.kinds[1] == tree.LITERAL
+
+    grammar = pg.AllOf(
+        pg.Ignore("a"),
+        pg.NamedPattern('y', pg.Insert("a")),
+        pg.NamedPattern('z', "b"))
+    compacted = pg.parse_string("ab", grammar, compact=True)
+    assert compacted.to_list() == ['', ['y', "a"], ['z', "b"]]
+    assert spans(compacted)[1:3] == [('y', 1, 1), (None, 1, 1)]
+    assert compacted.kinds[2] == tree.LITERAL
+
+    # A string that isn't a slice of the text is kept as it is
+    grammar = pg.AllOf("a\n", pg.Indented(pg.Words("bc\n")))
+    compacted = pg.parse_string("a\n  b\n  c", grammar, compact=True)
+    assert compacted.to_list() == ['', "a\n", "b\nc"]
+    assert compacted.kinds[2] == tree.LITERAL
+
+def test_compact_empty():
+    "Test that an empty match gives an empty tree"
+    compacted = pg.parse_string("x", pg.Optional("a"), compact=True)
+    assert len(compacted) == 0
+    assert compacted.to_list() == []
+    assert list(compacted.events()) == []
+    assert len(pg.compact([], "x")) == 0
+
+def test_compact_blocks():
+    "Test that a Many is compacted a block at a time"
+    data = "One *two* three\n\nFour\n\n*Five*"
+    for grammar in (get_grammar(), get_grammar().pattern):
+        compacted = pg.parse_string(data, grammar, compact=True)
+        assert compacted.to_list() == pg.parse_string(data, grammar)
+        assert (compacted.starts[0], compacted.ends[0]) == (0, len(data))
+
+    grammar = pg.Many(pg.Ignore("a"))
+    compacted = pg.parse_string("aa", grammar, compact=True)
+    assert compacted.to_list() == pg.parse_string("aa", grammar) == ['', ""]
+
+    locator = tree.Locator("ab")
+    grammar = pg.wrap_grammar(pg.Many(pg.NamedPattern('x', "a"), "b"), locator.wrap)
+    match = grammar.match_at("ab", 0)[0]
+    assert locator.located(match[1]) == (0, 1)
+    locator.forget(1)
+    assert locator.located(match[1]) is None
+    assert locator.located(match[2]) == (1, 2)